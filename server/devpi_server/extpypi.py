@@ -8,18 +8,24 @@ toxresult storage.
 from __future__ import unicode_literals
 
 import asyncio
+import concurrent.futures
 import time
 
 import re
-from devpi_common.vendor._pip import HTMLPage
+import sys
+import threading
 from devpi_common.url import URL
+from devpi_common.url import urljoin
 from devpi_common.metadata import BasenameMeta
-from devpi_common.metadata import is_archive_of_project
 from devpi_common.validation import normalize_name
+from repoze.lru import LRUCache
+from functools import lru_cache
 from functools import partial
+from html import unescape
 from html.parser import HTMLParser
 from .config import hookimpl
 from .exceptions import lazy_format_exception
+from .exceptions import lazy_format_exception_only
 from .filestore import key_from_link
 from .model import BaseStageCustomizer
 from .model import BaseStage, SimplelinkMeta
@@ -28,6 +34,19 @@ from .model import join_links_data
 from .readonly import ensure_deeply_readonly
 from .log import threadlog
 from .views import make_uuid_headers
+try:
+    from lxml.etree import HTMLPullParser as LXMLHTMLPullParser
+    from lxml.etree import XMLSyntaxError as LXMLSyntaxError
+except ImportError:
+    LXMLHTMLPullParser = None
+
+
+# memoized variant for the server side hot paths, where the names are
+# bounded by the projects of the mirror instead of arbitrary user input
+@lru_cache(maxsize=131072)
+def normalize_name_cached(name):
+    # interned, so the many references to a project name share one string
+    return sys.intern(normalize_name(name))
 
 
 class Link(URL):
@@ -37,48 +56,174 @@ class Link(URL):
         URL.__init__(self, url, *args, **kwargs)
 
 
-class ProjectParser(HTMLParser):
+# matches the href attribute of anchor tags, PyPI and devpi always quote it
+_HREF_RE = re.compile(
+    r'''<a\s(?:[^>]*?\s)?href\s*=\s*["']([^"']*)["']''', re.IGNORECASE)
+
+
+class ProjectParser:
     def __init__(self, url):
-        HTMLParser.__init__(self)
         self.projects = set()
         self.baseurl = URL(url)
         self.basehost = self.baseurl.replace(path='')
-        self.project = None
 
-    def handle_starttag(self, tag, attrs):
-        if tag == 'a':
-            self.project = None
-            attrs = dict(attrs)
-            if 'href' not in attrs:
-                return
-            href = attrs['href']
+    def feed(self, text):
+        # local names avoid attribute lookups for each of the many links
+        baseurl = self.baseurl
+        base_path = baseurl.path
+        basehost = self.basehost
+        projects_add = self.projects.add
+        for m in _HREF_RE.finditer(text):
+            href = m.group(1)
+            if '&' in href:
+                href = unescape(href)
             if '://' not in href:
                 project = href.rstrip('/').rsplit('/', 1)[-1]
             else:
-                newurl = self.baseurl.joinpath(href)
+                newurl = baseurl.joinpath(href)
                 # remove trailing slashes, so basename works correctly
                 newurl = newurl.asfile()
                 if not newurl.is_valid_http_url():
-                    return
-                if not newurl.path.startswith(self.baseurl.path):
-                    return
-                if self.basehost != newurl.replace(path=''):
-                    return
+                    continue
+                if not newurl.path.startswith(base_path):
+                    continue
+                if basehost != newurl.replace(path=''):
+                    continue
                 project = newurl.basename
-            self.project = project
+            if project:
+                # interned, as the names stay in the cache for long
+                projects_add(sys.intern(project))
+
+
+def _link_from_attrib(baseurl, attrib):
+    href = attrib.get('href')
+    if href is None:
+        return None
+    try:
+        href = urljoin(baseurl, href)
+    except ValueError:
+        return None
+    return (
+        href,
+        attrib.get('data-requires-python') or None,
+        'data-yanked' in attrib)
+
+
+class _HTMLParserLinkParser(HTMLParser):
+    def __init__(self, url):
+        HTMLParser.__init__(self)
+        self.baseurl = url
+        self._links = []
 
-    def handle_endtag(self, tag):
-        if tag == 'a' and self.project:
-            self.projects.add(self.project)
-            self.project = None
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            link = _link_from_attrib(self.baseurl, dict(attrs))
+            if link is not None:
+                self._links.append(link)
+        elif tag == 'base':
+            href = dict(attrs).get('href')
+            if href:
+                self.baseurl = href
+
+    def feed(self, text):
+        HTMLParser.feed(self, text)
+        return self._pop_links()
+
+    def close(self):
+        HTMLParser.close(self)
+        return self._pop_links()
+
+    def _pop_links(self):
+        (links, self._links) = (self._links, [])
+        return links
+
+
+class _LXMLLinkParser:
+    def __init__(self, url):
+        self.baseurl = url
+        self._parser = LXMLHTMLPullParser(events=("start", "end"))
+
+    def feed(self, text):
+        self._parser.feed(text)
+        return self._read_links()
+
+    def close(self):
+        try:
+            self._parser.close()
+        except LXMLSyntaxError:
+            # empty document
+            pass
+        return self._read_links()
+
+    def _read_links(self):
+        links = []
+        for event, element in self._parser.read_events():
+            tag = element.tag
+            if event == 'start':
+                if tag == 'a':
+                    link = _link_from_attrib(self.baseurl, element.attrib)
+                    if link is not None:
+                        links.append(link)
+                elif tag == 'base':
+                    href = element.get('href')
+                    if href:
+                        self.baseurl = href
+            elif tag == 'a':
+                # drop processed anchors, so the tree doesn't grow
+                parent = element.getparent()
+                element.clear()
+                if parent is not None:
+                    while element.getprevious() is not None:
+                        del parent[0]
+        return links
+
+
+def new_link_parser(url):
+    """ return an incremental parser for the anchors of a simple page.
+
+    Its ``feed(text)`` and ``close()`` methods return lists of
+    (url, requires_python, yanked) tuples for the anchors found so far. """
+    if LXMLHTMLPullParser is None:
+        return _HTMLParserLinkParser(url)
+    return _LXMLLinkParser(url)
+
+
+def iter_index_links(html, url):
+    """ yield (url, requires_python, yanked) tuples for all anchors
+    of a simple page. """
+    parser = new_link_parser(url)
+    yield from parser.feed(html)
+    yield from parser.close()
+
+
+# splits a basename into name/version and an allowed archive extension,
+# equivalent to splitext_archive and the ALLOWED_ARCHIVE_EXTS check done
+# by devpi_common.metadata.is_archive_of_project
+_ARCHIVE_RE = re.compile(
+    r"^(.+?)(?:\.doc\.zip|\.tar\.gz|\.tar\.bz2|"
+    r"(?<!\.tar)(?:\.tar|\.tgz|\.zip|\.whl|\.egg|\.exe|\.dmg|\.deb|\.msi|\.rpm))$",
+    re.IGNORECASE | re.ASCII)
+
+
+def _project_prefix_re(project):
+    # matches the start of a name/version if its normalized form starts
+    # with the given normalized project name
+    return re.compile(
+        "[^A-Za-z0-9]+".join(re.escape(x) for x in project.split("-")),
+        re.IGNORECASE | re.ASCII)
 
 
 class IndexParser:
 
     def __init__(self, project):
-        self.project = normalize_name(project)
+        self.project = normalize_name_cached(project)
+        self._project_re = _project_prefix_re(self.project)
         self.basename2link = {}
 
+    def is_archive_of_project(self, basename):
+        m = _ARCHIVE_RE.match(basename)
+        return m is not None and self._project_re.match(m.group(1)) is not None
+
     def _mergelink_ifbetter(self, newlink):
         """
         Stores a link given it's better fit than an existing one (if any).
@@ -99,23 +244,36 @@ class IndexParser:
 
     @property
     def releaselinks(self):
+        return list(self.iter_releaselinks())
+
+    def iter_releaselinks(self):
         # the BasenameMeta wrapping essentially does link validation
-        return [BasenameMeta(x).obj for x in self.basename2link.values()]
+        return (BasenameMeta(x).obj for x in self.basename2link.values())
 
     def parse_index(self, disturl, html):
-        p = HTMLPage(html, disturl.url)
-        seen = set()
-        for link in p.links:
-            newurl = Link(link.url, requires_python=link.requires_python, yanked=link.yanked)
+        self.add_links(iter_index_links(html, disturl.url))
+
+    async def async_parse_index(self, disturl, chunks):
+        link_parser = new_link_parser(disturl.url)
+        async for text in chunks:
+            self.add_links(link_parser.feed(text))
+        self.add_links(link_parser.close())
+
+    def add_links(self, links):
+        for (url, requires_python, yanked) in links:
+            newurl = Link(url, requires_python=requires_python, yanked=yanked)
             if not newurl.is_valid_http_url():
                 continue
-            if is_archive_of_project(newurl, self.project):
-                if not newurl.is_valid_http_url():
-                    threadlog.warn("unparsable/unsupported url: %r", newurl)
-                else:
-                    seen.add(newurl.url)
-                    self._mergelink_ifbetter(newurl)
-                    continue
+            if self.is_archive_of_project(newurl.basename):
+                self._mergelink_ifbetter(newurl)
+
+
+def _links_equal(links, newlinks):
+    # both lists come from join_links_data in simple page order, so
+    # unchanged links usually compare equal without building sets
+    if links is None or len(links) != len(newlinks):
+        return False
+    return links == newlinks or set(links) == set(newlinks)
 
 
 def parse_index(disturl, html):
@@ -127,6 +285,24 @@ def parse_index(disturl, html):
     return parser
 
 
+async def async_parse_index(disturl, chunks):
+    """ like parse_index, but parses the text chunks provided by an
+    async iterator while they arrive. """
+    if not isinstance(disturl, URL):
+        disturl = URL(disturl)
+    project = disturl.basename or disturl.parentbasename
+    parser = IndexParser(project)
+    await parser.async_parse_index(disturl, chunks)
+    return parser
+
+
+@lru_cache(maxsize=100000)
+def _log_offline_once(stagename, project):
+    # the cache makes sure we log about stale projects only once
+    threadlog.debug(
+        "using stale links for %r on %s due to offline mode", project, stagename)
+
+
 class PyPIStage(BaseStage):
     def __init__(self, xom, username, index, ixconfig, customizer_cls):
         super(PyPIStage, self).__init__(
@@ -136,8 +312,6 @@ class PyPIStage(BaseStage):
         self.timeout = xom.config.request_timeout
         # list of locally mirrored projects
         self.key_projects = self.keyfs.PROJNAMES(user=username, index=index)
-        # used to log about stale projects only once
-        self._offline_logging = set()
 
     def _get_extra_headers(self, extra_headers):
         if self.xom.is_replica():
@@ -156,6 +330,12 @@ class PyPIStage(BaseStage):
             url=URL(url).url, allow_redirects=allow_redirects, timeout=timeout,
             extra_headers=extra_headers)
 
+    def async_httpget_stream(self, url, allow_redirects, timeout=None, extra_headers=None):
+        extra_headers = self._get_extra_headers(extra_headers)
+        return self.xom.async_httpget_stream(
+            url=URL(url).url, allow_redirects=allow_redirects, timeout=timeout,
+            extra_headers=extra_headers)
+
     def httpget(self, url, allow_redirects, timeout=None, extra_headers=None):
         extra_headers = self._get_extra_headers(extra_headers)
         return self.xom.httpget(
@@ -222,7 +402,7 @@ class PyPIStage(BaseStage):
         BaseStage.delete(self)
 
     def add_project_name(self, project):
-        project = normalize_name(project)
+        project = normalize_name_cached(project)
         projects = self.key_projects.get(readonly=False)
         if project not in projects:
             projects.add(project)
@@ -267,10 +447,8 @@ class PyPIStage(BaseStage):
             raise self.NotFound("entry has no file data %r" % entry)
         entry.delete()
         (is_expired, links, cache_serial) = self._load_cache_links(project)
-        if links is not None:
-            links = ensure_deeply_readonly(
-                list(filter(self._is_file_cached, links)))
-        if not links and cleanup:
+        # we only need to know whether any file is left
+        if not (links and any(map(self._is_file_cached, links))) and cleanup:
             projects = self.key_projects.get(readonly=False)
             if project in projects:
                 projects.remove(project)
@@ -301,6 +479,36 @@ class PyPIStage(BaseStage):
             self.xom.set_singleton(self.name, "project_retrieve_times", c)
             return c
 
+    @property
+    def cache_version_index(self):
+        """ per-xom RAM cache of the versions in simplelinks per project. """
+        try:
+            return self.xom.get_singleton(self.name, "version_index")
+        except KeyError:
+            c = LRUCache(1000)  # is thread safe
+            self.xom.set_singleton(self.name, "version_index", c)
+            return c
+
+    @property
+    def cache_offline_links(self):
+        """ per-xom RAM cache of the links with existing files per project. """
+        try:
+            return self.xom.get_singleton(self.name, "offline_links")
+        except KeyError:
+            c = LRUCache(1000)  # is thread safe
+            self.xom.set_singleton(self.name, "offline_links", c)
+            return c
+
+    @property
+    def cache_joined_links(self):
+        """ per-xom RAM cache of the joined simplelinks per project. """
+        try:
+            return self.xom.get_singleton(self.name, "joined_links")
+        except KeyError:
+            c = LRUCache(1000)  # is thread safe
+            self.xom.set_singleton(self.name, "joined_links", c)
+            return c
+
     def _get_remote_projects(self):
         headers = {"Accept": "text/html"}
         # use a minimum of 30 seconds as timeout for remote server and
@@ -364,7 +572,7 @@ class PyPIStage(BaseStage):
     def _save_cache_links(self, project, links, requires_python, yanked, serial):
         assert links != ()  # we don't store the old "Not Found" marker anymore
         assert isinstance(serial, int)
-        assert project == normalize_name(project), project
+        assert project == normalize_name_cached(project), project
         data = {
             "serial": serial, "links": links,
             "requires_python": requires_python,
@@ -381,108 +589,150 @@ class PyPIStage(BaseStage):
         def on_commit():
             threadlog.debug("setting projects cache for %r", project)
             self.cache_retrieve_times.refresh(project)
+            self.cache_version_index.invalidate(project)
+            self.cache_joined_links.invalidate(project)
             # make project appear in projects list even
             # before we next check up the full list with remote
             self.cache_projectnames.add(project)
 
         self.keyfs.tx.on_commit_success(on_commit)
 
+    def _joined_cache_links(self, project, key, cache):
+        # joining is repeated for every simple page request, so the result
+        # is kept per project and reused as long as the key wasn't changed
+        if self.keyfs.tx.is_dirty(key):
+            last_serial = -1
+        else:
+            last_serial = self.get_last_project_change_serial_perstage(project)
+        if last_serial >= 0:
+            cached = self.cache_joined_links.get(project)
+            if cached is not None and cached[0] == (last_serial, cache["serial"]):
+                return cached[1]
+        links_with_data = join_links_data(
+            cache["links"],
+            cache.get("requires_python", []),
+            cache.get("yanked", []))
+        if last_serial >= 0:
+            self.cache_joined_links.put(
+                project, ((last_serial, cache["serial"]), links_with_data))
+        return links_with_data
+
     def _load_cache_links(self, project):
         is_expired, links_with_data, serial = True, None, -1
 
-        cache = self.key_projsimplelinks(project).get()
+        key = self.key_projsimplelinks(project)
+        cache = key.get()
         if cache:
             is_expired = self.cache_retrieve_times.is_expired(project, self.cache_expiry)
             serial = cache["serial"]
-            links_with_data = join_links_data(
-                cache["links"],
-                cache.get("requires_python", []),
-                cache.get("yanked", []))
+            links_with_data = self._joined_cache_links(project, key, cache)
             if self.offline and links_with_data:
-                links_with_data = ensure_deeply_readonly(list(
-                    filter(self._is_file_cached, links_with_data)))
+                links_with_data = self._filter_cached_files(
+                    project, links_with_data)
 
         return is_expired, links_with_data, serial
 
     def _entry_from_href(self, href):
         # extract relpath from href by cutting of the hash
-        relpath = re.sub(r"#.*$", "", href)
+        relpath = href.split('#', 1)[0]
         return self.filestore.get_file_entry(relpath)
 
+    def _filter_cached_files(self, project, links):
+        # in offline mode the same filtered links are requested over and
+        # over, so we keep them until the next serial. In write
+        # transactions there may be uncommitted file changes.
+        tx = self.keyfs.tx
+        if not tx.write:
+            cached = self.cache_offline_links.get(project)
+            if cached is not None and cached[0] == tx.at_serial and cached[1] is links:
+                return cached[2]
+        result = ensure_deeply_readonly(list(
+            filter(self._is_file_cached, links)))
+        if not tx.write:
+            self.cache_offline_links.put(
+                project, (tx.at_serial, links, result))
+        return result
+
     def _is_file_cached(self, link):
-        entry = self._entry_from_href(link[1])
+        relpath = link[1].split('#', 1)[0]
+        entry = self.filestore.get_file_entry(relpath)
         return entry is not None and entry.file_exists()
 
     def clear_simplelinks_cache(self, project):
         # we have to set to an empty dict instead of removing the key, so
         # replicas behave correctly
         self.cache_retrieve_times.expire(project)
+        self.cache_joined_links.invalidate(project)
         self.key_projsimplelinks(project).set({})
         threadlog.debug("cleared cache for %s", project)
 
-    async def _async_fetch_releaselinks(self, newlinks_future, project, cache_serial, _key_from_link):
+    async def _async_fetch_releaselinks(self, project, cache_serial, _key_from_link):
         # get the simple page for the project
         url = self.mirror_url.joinpath(project).asdir()
         threadlog.debug("reading index %r", url)
-        (response, text) = await self.async_httpget(url, allow_redirects=True)
-        if response.status != 200:
-            if response.status == 404:
-                self.cache_retrieve_times.refresh(project)
-                raise self.UpstreamNotFoundError(
-                    "not found on GET %r" % url)
-
-            # we don't have an old result and got a non-404 code.
-            raise self.UpstreamError("%s status on GET %r" % (
-                response.status, url))
-
-        # pypi.org provides X-PYPI-LAST-SERIAL header in case of 200 returns.
-        # devpi-master may provide a 200 but not supply the header
-        # (it's really a 404 in disguise and we should change
-        # devpi-server behaviour since pypi.org serves 404
-        # on non-existing projects for a longer time now).
-        # Returning a 200 with "no such project" was originally meant to
-        # provide earlier versions of easy_install/pip to request the full
-        # simple page.
-        try:
-            serial = int(response.headers.get(str("X-PYPI-LAST-SERIAL")))
-        except (TypeError, ValueError):
-            # handle missing or invalid X-PYPI-LAST-SERIAL header
-            serial = -1
-
-        if serial < cache_serial:
-            raise self.UpstreamError(
-                "serial mismatch on GET %r, "
-                "cache_serial %s is newer than returned serial %s" % (
-                    url, cache_serial, serial))
-
-        threadlog.debug("%s: got response with serial %s", project, serial)
-
-        # check returned url has the same normalized name
-        assert project == normalize_name(url.asfile().basename)
-
-        # make sure we don't store credential in the database
-        response_url = URL(response.url).replace(username=None, password=None)
-        # parse simple index's link
-        releaselinks = parse_index(response_url, text).releaselinks
-        num_releaselinks = len(releaselinks)
-        key_hrefs = [None] * num_releaselinks
-        requires_python = [None] * num_releaselinks
-        yanked = [None] * num_releaselinks
-        for index, releaselink in enumerate(releaselinks):
-            key = _key_from_link(releaselink)
-            href = key.relpath
+        stream = self.async_httpget_stream(url, allow_redirects=True)
+        async with stream as (response, chunks):
+            if response.status != 200:
+                if response.status == 404:
+                    self.cache_retrieve_times.refresh(project)
+                    raise self.UpstreamNotFoundError(
+                        "not found on GET %r" % url)
+
+                # we don't have an old result and got a non-404 code.
+                raise self.UpstreamError("%s status on GET %r" % (
+                    response.status, url))
+
+            # pypi.org provides X-PYPI-LAST-SERIAL header in case of 200 returns.
+            # devpi-master may provide a 200 but not supply the header
+            # (it's really a 404 in disguise and we should change
+            # devpi-server behaviour since pypi.org serves 404
+            # on non-existing projects for a longer time now).
+            # Returning a 200 with "no such project" was originally meant to
+            # provide earlier versions of easy_install/pip to request the full
+            # simple page.
+            try:
+                serial = int(response.headers.get(str("X-PYPI-LAST-SERIAL")))
+            except (TypeError, ValueError):
+                # handle missing or invalid X-PYPI-LAST-SERIAL header
+                serial = -1
+
+            if serial < cache_serial:
+                raise self.UpstreamError(
+                    "serial mismatch on GET %r, "
+                    "cache_serial %s is newer than returned serial %s" % (
+                        url, cache_serial, serial))
+
+            threadlog.debug("%s: got response with serial %s", project, serial)
+
+            # check returned url has the same normalized name
+            assert project == normalize_name_cached(url.asfile().basename)
+
+            # make sure we don't store credential in the database
+            response_url = URL(response.url).replace(username=None, password=None)
+            # parse simple index's link while the page is arriving
+            parser = await async_parse_index(response_url, chunks)
+        # the links themselves are only needed for maplink on master,
+        # the replica gets the file entries through replication
+        releaselinks = None if self.xom.is_replica() else []
+        key_hrefs = []
+        requires_python = []
+        yanked = []
+        for releaselink in parser.iter_releaselinks():
+            href = _key_from_link(releaselink).relpath
             if releaselink.hash_spec:
                 href = f"{href}#{releaselink.hash_spec}"
-            key_hrefs[index] = (releaselink.basename, href)
-            requires_python[index] = releaselink.requires_python
-            yanked[index] = releaselink.yanked
-        newlinks_future.set_result(dict(
+            key_hrefs.append((releaselink.basename, href))
+            requires_python.append(releaselink.requires_python)
+            yanked.append(releaselink.yanked)
+            if releaselinks is not None:
+                releaselinks.append(releaselink)
+        return dict(
             serial=serial,
             releaselinks=releaselinks,
             key_hrefs=key_hrefs,
             requires_python=requires_python,
             yanked=yanked,
-            devpi_serial=response.headers.get("X-DEVPI-SERIAL")))
+            devpi_serial=response.headers.get("X-DEVPI-SERIAL"))
 
     def _update_simplelinks(self, project, info, newlinks):
         if self.xom.is_replica():
@@ -512,12 +762,10 @@ class PyPIStage(BaseStage):
                 # write transaction.
                 self.keyfs.restart_as_write_transaction()
 
-            maplink = partial(
-                self.filestore.maplink,
+            # mapping the links creates the entries in the database
+            self.filestore.maplink_many(
+                info["releaselinks"],
                 user=self.user.name, index=self.index, project=project)
-            # calling maplink on the links creates the entries in the database
-            for x in info["releaselinks"]:
-                maplink(x)
             # this stores the simple links info
             self._save_cache_links(
                 project,
@@ -525,23 +773,35 @@ class PyPIStage(BaseStage):
                 info["serial"])
             return newlinks
 
-    async def _update_simplelinks_in_future(self, newlinks_future, project):
+    async def _update_simplelinks_in_future(self, future, project):
         threadlog.debug("Awaiting simple links for %r", project)
-        info = await newlinks_future
+        try:
+            info = await asyncio.wrap_future(future)
+        except Exception as e:
+            threadlog.warn(
+                "could not get simple links for %r in background: %s",
+                project, lazy_format_exception_only(e))
+            return
         threadlog.debug("Got simple links for %r", project)
 
         newlinks = join_links_data(
             info["key_hrefs"], info["requires_python"], info["yanked"])
-        with self.keyfs.transaction(write=True):
-            # fetch current links
-            (is_expired, links, cache_serial) = self._load_cache_links(project)
-            if links is None or set(links) != set(newlinks):
-                # we got changes, so store them
-                self._update_simplelinks(project, info, newlinks)
-                threadlog.debug(
-                    "Updated simplelinks for %r in background", project)
-            else:
-                threadlog.debug("Unchanged simplelinks for %r", project)
+        try:
+            with self.keyfs.transaction(write=True):
+                # fetch current links
+                (is_expired, links, cache_serial) = self._load_cache_links(project)
+                if not _links_equal(links, newlinks):
+                    # we got changes, so store them
+                    self._update_simplelinks(project, info, newlinks)
+                    threadlog.debug(
+                        "Updated simplelinks for %r in background", project)
+                else:
+                    threadlog.debug("Unchanged simplelinks for %r", project)
+        except Exception:
+            # nobody waits for the result of this coroutine, so this
+            # is the only place where the error can be reported
+            threadlog.exception(
+                "could not update simple links for %r in background", project)
 
     def get_simplelinks_perstage(self, project):
         """ return all releaselinks from the index, returning cached entries
@@ -556,10 +816,8 @@ class PyPIStage(BaseStage):
         if self.offline and links is None:
             raise self.UpstreamError("offline mode")
         if self.offline or not is_expired:
-            if self.offline and project not in self._offline_logging:
-                threadlog.debug(
-                    "using stale links for %r due to offline mode", project)
-                self._offline_logging.add(project)
+            if self.offline:
+                _log_offline_once(self.name, project)
             return links
 
         is_retrieval_expired = self.cache_retrieve_times.is_expired(
@@ -569,23 +827,23 @@ class PyPIStage(BaseStage):
             raise self.UpstreamNotFoundError(
                 "cached not found for project %s" % project)
 
-        newlinks_future = self.xom.create_future()
         # we need to set this up here, as these access the database and
         # the async loop has no transaction
         _key_from_link = partial(
             key_from_link, self.keyfs, user=self.user.name, index=self.index)
+        # the fetch keeps running on the async loop if we stop waiting
+        future = self.xom.submit_coroutine(
+            self._async_fetch_releaselinks(
+                project, cache_serial, _key_from_link))
         try:
-            self.xom.run_coroutine_threadsafe(
-                self._async_fetch_releaselinks(
-                    newlinks_future, project, cache_serial, _key_from_link),
-                timeout=self.timeout)
-        except asyncio.TimeoutError:
+            info = future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
             if not self.xom.is_replica():
-                # we process the future in the background
+                # we process the result in the background
                 # but only on master, the replica will get the update
                 # via the replication thread
-                self.xom.create_task(
-                    self._update_simplelinks_in_future(newlinks_future, project))
+                self.xom.submit_coroutine(
+                    self._update_simplelinks_in_future(future, project))
             # to prevent a buildup of updates we mark the project as fresh
             self.cache_retrieve_times.refresh(project)
             if links is not None:
@@ -606,17 +864,73 @@ class PyPIStage(BaseStage):
                 return links
             raise
 
-        info = newlinks_future.result()
+        return self._update_simplelinks_if_changed(project, info, links)
 
+    def _update_simplelinks_if_changed(self, project, info, links):
         newlinks = join_links_data(
             info["key_hrefs"], info["requires_python"], info["yanked"])
-        if links is not None and set(links) == set(newlinks):
+        if _links_equal(links, newlinks):
             # no changes
             self.cache_retrieve_times.refresh(project)
             return links
 
         return self._update_simplelinks(project, info, newlinks)
 
+    async def _async_fetch_many(self, project2serial, _key_from_link, limit=16):
+        sem = asyncio.Semaphore(limit)
+
+        async def fetch(project, cache_serial):
+            async with sem:
+                return await asyncio.wait_for(
+                    self._async_fetch_releaselinks(
+                        project, cache_serial, _key_from_link),
+                    self.timeout)
+
+        # exceptions are returned, so one failing project doesn't
+        # cancel the fetches of the others
+        return await asyncio.gather(
+            *(fetch(p, s) for p, s in project2serial.items()),
+            return_exceptions=True)
+
+    def refresh_projects(self, projects):
+        """ fetch the simple pages of the given projects concurrently
+        and update the cached links where they changed.
+
+        Returns a dictionary of project names to their current links
+        for the projects which could be refreshed. """
+        project2links = {}
+        project2serial = {}
+        for project in projects:
+            project = normalize_name(project)
+            (is_expired, links, cache_serial) = self._load_cache_links(project)
+            project2links[project] = links
+            project2serial[project] = cache_serial
+        if self.offline:
+            # like get_simplelinks_perstage, never fetch in offline mode
+            # and use the cached links
+            refreshed = {}
+            for project, links in project2links.items():
+                if links is not None:
+                    _log_offline_once(self.name, project)
+                    refreshed[project] = links
+            return refreshed
+        # we need to set this up here, as these access the database and
+        # the async loop has no transaction
+        _key_from_link = partial(
+            key_from_link, self.keyfs, user=self.user.name, index=self.index)
+        results = self.xom.run_coroutine_threadsafe(
+            self._async_fetch_many(project2serial, _key_from_link))
+        refreshed = {}
+        for project, info in zip(project2serial, results):
+            if isinstance(info, BaseException):
+                threadlog.warn(
+                    "could not refresh links for %r: %s",
+                    project, lazy_format_exception_only(info))
+                continue
+            refreshed[project] = self._update_simplelinks_if_changed(
+                project, info, project2links[project])
+        return refreshed
+
     def has_project_perstage(self, project):
         if self.is_project_cached(project):
             return True
@@ -626,10 +940,23 @@ class PyPIStage(BaseStage):
             return False
         return True
 
+    def _version_index(self, project):
+        """ return dictionary of versions to the SimplelinkMeta of their links. """
+        project = normalize_name(project)
+        links = self.get_simplelinks_perstage(project)
+        cache = self.cache_version_index
+        cached = cache.get(project)
+        if cached is not None and links == cached[0]:
+            return cached[1]
+        index = {}
+        for sm in map(SimplelinkMeta, links):
+            index.setdefault(sm.version, []).append(sm)
+        cache.put(project, (list(links), index))
+        return index
+
     def list_versions_perstage(self, project):
         try:
-            return set(x.version
-                       for x in map(SimplelinkMeta, self.get_simplelinks_perstage(project)))
+            return set(self._version_index(project))
         except self.UpstreamNotFoundError:
             return []
 
@@ -649,19 +976,17 @@ class PyPIStage(BaseStage):
     def get_versiondata_perstage(self, project, version, readonly=True):
         project = normalize_name(project)
         verdata = {}
-        for sm in map(SimplelinkMeta, self.get_simplelinks_perstage(project)):
-            link_version = sm.version
-            if version == link_version:
-                if not verdata:
-                    verdata['name'] = project
-                    verdata['version'] = version
-                if sm.require_python is not None:
-                    verdata['requires_python'] = sm.require_python
-                if sm.yanked:
-                    verdata['yanked'] = sm.yanked
-                elinks = verdata.setdefault("+elinks", [])
-                entrypath = sm._url.path
-                elinks.append({"rel": "releasefile", "entrypath": entrypath})
+        for sm in self._version_index(project).get(version, ()):
+            if not verdata:
+                verdata['name'] = project
+                verdata['version'] = version
+            if sm.require_python is not None:
+                verdata['requires_python'] = sm.require_python
+            if sm.yanked:
+                verdata['yanked'] = sm.yanked
+            elinks = verdata.setdefault("+elinks", [])
+            entrypath = sm._url.path
+            elinks.append({"rel": "releasefile", "entrypath": entrypath})
         if readonly:
             return ensure_deeply_readonly(verdata)
         return verdata
@@ -682,7 +1007,15 @@ class ProjectNamesCache:
     """ Helper class for maintaining project names from a mirror. """
     def __init__(self):
         self._timestamp = -1
-        self._data = frozenset()
+        self._data = set()
+        # frozen copy handed out by get, rebuilt lazily after changes
+        self._snapshot = frozenset()
+        # the cache is shared between threads, so changes and the rebuild
+        # of the snapshot must not interleave
+        self._lock = threading.Lock()
+
+    def __contains__(self, project):
+        return project in self._data
 
     def exists(self):
         return self._timestamp != -1
@@ -691,21 +1024,35 @@ class ProjectNamesCache:
         return (time.time() - self._timestamp) >= expiry_time
 
     def get(self):
-        """ Get a copy of the cached data. """
-        return self._data
+        """ Get a read-only copy of the cached data. """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    snapshot = self._snapshot = frozenset(self._data)
+        return snapshot
 
     def add(self, project):
         """ Add project to cache. """
-        self._data = self._data.union({project})
+        with self._lock:
+            if project not in self._data:
+                self._data.add(project)
+                self._snapshot = None
 
     def discard(self, project):
         """ Remove project from cache. """
-        self._data = self._data.difference({project})
+        with self._lock:
+            if project in self._data:
+                self._data.discard(project)
+                self._snapshot = None
 
     def set(self, data):
         """ Set data and update timestamp. """
-        if data is not self._data:
-            self._data = frozenset(data)
+        with self._lock:
+            if data is not self._snapshot:
+                self._data = set(data)
+                self._snapshot = data if isinstance(data, frozenset) else None
         self.mark_current()
 
     def mark_current(self):
@@ -713,21 +1060,24 @@ class ProjectNamesCache:
 
 
 class ProjectUpdateCache:
-    """ Helper class to manage when we last updated something project specific. """
+    """ Helper class to manage when we last updated something project specific.
+
+    Uses integer nanoseconds of the monotonic clock, so wall clock
+    adjustments don't affect expiry. """
     def __init__(self):
         self._project2time = {}
 
     def is_expired(self, project, expiry_time):
         t = self._project2time.get(project)
         if t is not None:
-            return (time.time() - t) >= expiry_time
+            return (time.monotonic_ns() - t) >= expiry_time * 1_000_000_000
         return True
 
     def get_timestamp(self, project):
         return self._project2time.get(project, 0)
 
     def refresh(self, project):
-        self._project2time[project] = time.time()
+        self._project2time[project] = time.monotonic_ns()
 
     def expire(self, project):
         self._project2time.pop(project, None)
@@ -115,6 +115,32 @@ class FileStore:
             entry.version = version
         return entry
 
+    def maplink_many(self, links, user, index, project):
+        """ Like maplink for each of the links, but sets the metadata of
+        each entry in one go and only if it changed. """
+        keyfs = self.keyfs
+        for link in links:
+            key = key_from_link(keyfs, link, user, index)
+            meta = key.get(readonly=False)
+            changed = False
+            values = [
+                ("url", link.geturl_nofragment().url),
+                ("hash_spec", unicode_if_bytes(link.hash_spec)),
+                ("project", project)]
+            try:
+                (projectname, version, ext) = splitbasename(link.basename)
+            except ValueError:
+                pass
+            else:
+                # only store version if we can determine it, see maplink
+                values.append(("version", version))
+            for name, val in values:
+                if meta.get(name) != val:
+                    meta[name] = val
+                    changed = True
+            if changed:
+                key.set(meta)
+
     def get_key_from_relpath(self, relpath):
         try:
             key = self.keyfs.tx.derive_key(relpath)
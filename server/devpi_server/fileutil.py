@@ -112,8 +112,92 @@ def load(fp, _from_bytes=int.from_bytes, _unpack=unpack):
     return stack_pop(0)
 
 
-def loads(data):
-    return load(BytesIO(data))
+def loads(data, _from_bytes=int.from_bytes, _unpack=unpack):
+    # same as load, but works on the bytes directly instead of reading
+    # from a file object, with the most common opcodes checked first
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    end = len(data)
+    pos = 0
+    stack = []
+    stack_append = stack.append
+    stack_pop = stack.pop
+
+    def _read_int():
+        nonlocal pos
+        pos += 4
+        return _from_bytes(data[pos - 4:pos], byteorder="big", signed=True)
+
+    def _read(length):
+        nonlocal pos
+        pos += length
+        return data[pos - length:pos]
+
+    def _load_collection(type_):
+        length = _read_int()
+        if length:
+            res = type_(stack[-length:])
+            del stack[-length:]
+            stack_append(res)
+        else:
+            stack_append(type_())
+
+    stopped = False
+    while True:
+        if pos >= end:
+            raise EOFError
+        opcode = data[pos]
+        pos += 1
+        if opcode == 0x50:  # P setitem
+            try:
+                value = stack_pop()
+                key = stack_pop()
+            except IndexError:
+                raise LoadError("not enough items for setitem")
+            stack[-1][key] = value
+        elif opcode == 0x4e or opcode == 0x53:  # N, S Python 3 string, unicode
+            stack_append(_read(_read_int()).decode('utf-8'))
+        elif opcode == 0x46 or opcode == 0x47:  # F, G int, long
+            stack_append(_read_int())
+        elif opcode == 0x4a:  # J dict
+            stack_append({})
+        elif opcode == 0x4c:  # L None
+            stack_append(None)
+        elif opcode == 0x40:  # @ tuple
+            _load_collection(tuple)
+        elif opcode == 0x52:  # R True
+            stack_append(True)
+        elif opcode == 0x43:  # C False
+            stack_append(False)
+        elif opcode == 0x4b:  # K list
+            stack_append([None] * _read_int())
+        elif opcode == 0x51:  # Q stop
+            stopped = True
+            break
+        elif opcode == 0x41 or opcode == 0x4d:  # A bytes, M Python 2 string
+            stack_append(_read(_read_int()))
+        elif opcode == 0x42:  # B Channel
+            raise NotImplementedError("opcode B for Channel")
+        elif opcode == 0x44:  # D float
+            stack_append(_unpack("!d", _read(8))[0])
+        elif opcode == 0x45:  # E frozenset
+            _load_collection(frozenset)
+        elif opcode == 0x48 or opcode == 0x49:  # H, I longint, longlong
+            stack_append(int(_read(_read_int())))
+        elif opcode == 0x4f:  # O set
+            _load_collection(set)
+        elif opcode == 0x54:  # T complex
+            stack_append(complex(_unpack("!d", _read(8))[0], _unpack("!d", _read(8))[0]))
+        else:
+            # the typo is also in execnet and we compare execnet output directly
+            # in tests, so it needs to be here
+            raise LoadError(
+                "unkown opcode %r - wire protocol corruption?" % bytes((opcode,)))
+    if not stopped:
+        raise LoadError("didn't get STOP")
+    if len(stack) != 1:
+        raise LoadError("internal unserialization error")
+    return stack_pop(0)
 
 
 def _dump_tuple(write, obj, _pack=pack):
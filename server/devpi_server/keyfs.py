@@ -235,7 +235,8 @@ class KeyFS(object):
     def get_connection(self, closing=True, write=False):
         conn = IStorageConnection3(
             self._storage.get_connection(closing=False, write=write))
-        if closing:
+        if closing and not isinstance(conn, contextlib.AbstractContextManager):
+            # connections of storage plugins might not be context managers
             return contextlib.closing(conn)
         return conn
 
@@ -580,6 +581,9 @@ class Transaction(object):
             at_serial = self.conn.last_changelog_serial
         self.at_serial = at_serial
         self._original = {}
+        # last serials of keys looked up by get_original, -1 if a key
+        # never existed, used as back_serial on commit
+        self._original_serials = {}
         self.cache = {}
         self.dirty = set()
         self.closed = False
@@ -647,8 +651,15 @@ class Transaction(object):
         try:
             return self._original[typedkey]
         except KeyError:
-            # will raise KeyError if it doesn't exist
-            val = self.get_value_at(typedkey, self.at_serial)
+            result = self.get_last_serial_and_value_at(
+                typedkey, self.at_serial, raise_on_error=False)
+            if result is None:
+                self._original_serials[typedkey] = -1
+                raise KeyError(typedkey.relpath)
+            (last_serial, val) = result
+            self._original_serials[typedkey] = last_serial
+            if val is None:
+                raise KeyError(typedkey.relpath)  # was deleted
             assert is_deeply_readonly(val)
             self._original[typedkey] = val
         return val
@@ -725,10 +736,19 @@ class Transaction(object):
             return self._close()
         try:
             with self.conn.write_transaction() as fswriter:
+                # the writer holds the write lock now, if nothing was
+                # committed since the start of the transaction, the storage
+                # doesn't need to look up the back serials of keys we know
+                if getattr(fswriter, "commit_serial", None) == self.at_serial + 1:
+                    back_serials = self._original_serials
+                else:
+                    back_serials = {}
                 for typedkey in self.dirty:
                     val = self.cache.get(typedkey)
                     # None signals deletion
-                    fswriter.record_set(typedkey, val)
+                    fswriter.record_set(
+                        typedkey, val,
+                        back_serial=back_serials.get(typedkey))
                 commit_serial = getattr(fswriter, "commit_serial", notset)
                 if commit_serial is notset:
                     # for storages which don't have the attribute yet
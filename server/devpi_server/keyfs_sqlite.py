@@ -7,26 +7,108 @@ from .keyfs import get_relpath_at
 from .log import threadlog, thread_push_log, thread_pop_log
 from .mythread import current_thread
 from .readonly import ReadonlyView
-from .readonly import ensure_deeply_readonly, get_mutable_deepcopy
+from .readonly import ensure_deeply_readonly
 from .sizeof import gettotalsizeof
-from repoze.lru import LRUCache
+from collections import OrderedDict
+from itertools import groupby
+from operator import itemgetter
 from zope.interface import implementer
-import contextlib
+import heapq
+import logging
 import os
 import py
 import sqlite3
+import threading
 import time
 
 
 absent = object()
 
 
+class TwoQueueCache:
+    """ Thread safe 2Q cache with the statistics of repoze.lru.LRUCache.
+
+    New entries go into a FIFO queue which takes a quarter of the size.
+    Only entries requested again after they were pushed out of it end up
+    in the main LRU queue, so scans over many entries which are used
+    only once, like iter_relpaths_at, don't evict the often used ones. """
+
+    def __init__(self, size):
+        self.size = size
+        self.in_size = max(1, size // 4)
+        # keys pushed out of the FIFO queue, without their values
+        self.out_size = max(1, size // 2)
+        self._in = OrderedDict()
+        self._out = OrderedDict()
+        self._main = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.hits = 0
+        self.lookups = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._in) + len(self._main)
+
+    def get(self, key, default=None):
+        with self._lock:
+            self.lookups += 1
+            try:
+                val = self._main[key]
+            except KeyError:
+                try:
+                    val = self._in[key]
+                except KeyError:
+                    self.misses += 1
+                    return default
+            else:
+                self._main.move_to_end(key)
+            self.hits += 1
+            return val
+
+    def put(self, key, val):
+        with self._lock:
+            if key in self._main:
+                self._main[key] = val
+                self._main.move_to_end(key)
+                return
+            if key in self._in:
+                self._in[key] = val
+                return
+            if self._out.pop(key, absent) is absent:
+                self._in[key] = val
+            else:
+                self._main[key] = val
+            while len(self._in) + len(self._main) > self.size:
+                if len(self._in) > self.in_size or not self._main:
+                    (old_key, old_val) = self._in.popitem(last=False)
+                    self._out[old_key] = None
+                    if len(self._out) > self.out_size:
+                        self._out.popitem(last=False)
+                else:
+                    self._main.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._in.pop(key, None)
+            self._out.pop(key, None)
+            self._main.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._in.clear()
+            self._out.clear()
+            self._main.clear()
+
+
 class BaseConnection:
     _get_relpath_at = get_relpath_at
 
-    def __init__(self, sqlconn, basedir, storage):
+    def __init__(self, sqlconn, basedir, storage, write=False):
         self._sqlconn = sqlconn
         self._basedir = basedir
+        self._write = write
         self.dirty_files = {}
         self.storage = storage
         self._changelog_cache = storage._changelog_cache
@@ -53,36 +135,40 @@ class BaseConnection:
         for row in rows:
             print(row)
 
+    # the queries are executed on the connection directly, which uses a
+    # temporary cursor and the statement cache of the connection
+
     def fetchall(self, query, *args):
-        c = self._sqlconn.cursor()
         # print(query)
         # self._print_rows(self._explain(query, *args))
         # self._print_rows(self._explain_query_plan(query, *args))
-        r = c.execute(query, *args)
-        result = r.fetchall()
-        c.close()
-        return result
+        return self._sqlconn.execute(query, *args).fetchall()
 
     def fetchone(self, query, *args):
-        c = self._sqlconn.cursor()
         # print(query)
         # self._print_rows(self._explain(query, *args))
         # self._print_rows(self._explain_query_plan(query, *args))
-        r = c.execute(query, *args)
-        result = r.fetchone()
-        c.close()
-        return result
+        return self._sqlconn.execute(query, *args).fetchone()
 
     def iterall(self, query, *args):
-        c = self._sqlconn.cursor()
         # print(query)
         # self._print_rows(self._explain(query, *args))
         # self._print_rows(self._explain_query_plan(query, *args))
-        yield from c.execute(query, *args)
-        c.close()
+        yield from self._sqlconn.execute(query, *args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, cls, val, tb):
+        # anything not committed is rolled back on release
+        self.close()
 
     def close(self):
-        self._sqlconn.close()
+        sqlconn = self._sqlconn
+        if sqlconn is not None:
+            # the sqlite connection is kept for reuse by this thread
+            self._sqlconn = None
+            self.storage._release_sqlconn(sqlconn, self._write)
 
     def commit(self):
         self._sqlconn.commit()
@@ -92,7 +178,17 @@ class BaseConnection:
 
     @cached_property
     def last_changelog_serial(self):
-        return self.db_read_last_changelog_serial()
+        if self._write:
+            # writers are serialized by the database, so the next serial
+            # must always come from there
+            serial = self.db_read_last_changelog_serial()
+            self.storage._update_last_serial(serial)
+            return serial
+        serial = self.storage._last_serial
+        if serial is None:
+            serial = self.db_read_last_changelog_serial()
+            self.storage._update_last_serial(serial)
+        return serial
 
     def db_read_last_changelog_serial(self):
         q = 'SELECT MAX(_ROWID_) FROM "changelog" LIMIT 1'
@@ -110,6 +206,31 @@ class BaseConnection:
         q = "INSERT OR REPLACE INTO kv (key, keyname, serial) VALUES (?, ?, ?)"
         self.fetchone(q, (relpath, name, next_serial))
 
+    def db_write_typedkeys(self, changes, next_serial):
+        """ Write the keys of the changes with next_serial in one go.
+
+        A back_serial of None in changes is replaced with the last serial
+        of the key, or -1 if it didn't exist yet. """
+        missing = [
+            relpath for relpath, (keyname, back_serial, value) in changes.items()
+            if back_serial is None]
+        # stay below the default limit of variables in a query
+        for i in range(0, len(missing), 500):
+            relpaths = missing[i:i + 500]
+            q = "SELECT key, serial FROM kv WHERE key IN (%s)" % (
+                ", ".join("?" * len(relpaths)))
+            for relpath, serial in self.fetchall(q, relpaths):
+                (keyname, back_serial, value) = changes[relpath]
+                changes[relpath] = (keyname, serial, value)
+        for relpath in missing:
+            (keyname, back_serial, value) = changes[relpath]
+            if back_serial is None:
+                changes[relpath] = (keyname, -1, value)
+        q = "INSERT OR REPLACE INTO kv (key, keyname, serial) VALUES (?, ?, ?)"
+        self._sqlconn.executemany(q, (
+            (relpath, keyname, next_serial)
+            for relpath, (keyname, back_serial, value) in changes.items()))
+
     def write_changelog_entry(self, serial, entry):
         threadlog.debug("writing changelog for serial %s", serial)
         data = dumps(entry)
@@ -136,18 +257,24 @@ class BaseConnection:
             self._changelog_cache.put(serial, changes)
         return changes
 
-    def get_relpath_at(self, relpath, serial):
+    def get_relpath_at(self, relpath, serial, _small=(bool, int, type(None))):
+        # cache hits are returned directly, the size of the
+        # result is only determined for new cache entries
         result = self._relpath_cache.get((serial, relpath), absent)
-        if result is absent:
-            result = self._changelog_cache.get((serial, relpath), absent)
-        if result is absent:
-            changes = self._changelog_cache.get(serial, absent)
-            if changes is not absent and relpath in changes:
-                (keyname, back_serial, value) = changes[relpath]
-                result = (serial, back_serial, value)
-        if result is absent:
+        if result is not absent:
+            return result
+        result = self._changelog_cache.get((serial, relpath), absent)
+        if result is not absent:
+            return result
+        changes = self._changelog_cache.get(serial, absent)
+        if changes is not absent and relpath in changes:
+            (keyname, back_serial, value) = changes[relpath]
+            result = (serial, back_serial, value)
+        else:
             result = self._get_relpath_at(relpath, serial)
-        if gettotalsizeof(result, maxlen=100000) is None:
+        if (
+                not isinstance(result[2], _small)
+                and gettotalsizeof(result, maxlen=100000) is None):
             # result is big, put it in the changelog cache,
             # which has fewer entries to preserve memory
             self._changelog_cache.put((serial, relpath), result)
@@ -158,21 +285,21 @@ class BaseConnection:
 
     def iter_relpaths_at(self, typedkeys, at_serial):
         keynames = frozenset(k.name for k in typedkeys)
-        keyname_id_values = {"keynameid%i" % i: k for i, k in enumerate(keynames)}
+        # one query per keyname, so sqlite walks kv_keyname_serial_idx
+        # backwards and streams the rows without sorting them first
         q = """
             SELECT key, keyname, serial
             FROM kv
-            WHERE serial=:serial AND keyname IN (:keynames)
+            WHERE keyname=? AND serial<=?
+            ORDER BY serial DESC
         """
-        q = q.replace(':keynames', ", ".join(':' + x for x in keyname_id_values))
-        for serial in range(at_serial, -1, -1):
-            rows = self.fetchall(q, dict(
-                serial=serial,
-                **keyname_id_values))
-            if not rows:
-                continue
+        rows = heapq.merge(
+            *(self.iterall(q, (keyname, at_serial)) for keyname in keynames),
+            key=itemgetter(2), reverse=True)
+        # the changelog entry is only needed for serials with matching keys
+        for serial, serial_rows in groupby(rows, key=itemgetter(2)):
             changes = self.get_changes(serial)
-            for relpath, keyname, serial in rows:
+            for relpath, keyname, serial in serial_rows:
                 (keyname, back_serial, val) = changes[relpath]
                 yield RelpathInfo(
                     relpath=relpath, keyname=keyname,
@@ -199,6 +326,10 @@ class Connection(BaseConnection):
         self.dirty_files[path] = True
 
     def io_file_open(self, path):
+        # BytesIO shares the buffer of the bytes object, so this doesn't
+        # copy the content again. A blob handle from blobopen can't be
+        # used, as the file is often read after the transaction ended and
+        # the sqlite connection was reused or closed.
         return py.io.BytesIO(self.io_file_get(path))
 
     def io_file_get(self, path):
@@ -230,39 +361,53 @@ class Connection(BaseConnection):
 
 
 class BaseStorage(object):
+    # seconds sqlite waits for locks held by other connections
+    _timeout = 60
+
     def __init__(self, basedir, notify_on_commit, cache_size):
         self.basedir = basedir
         self.sqlpath = self.basedir.join(self.db_filename)
+        self._uri_template = "file:%s?mode=%%s" % self.sqlpath
         self._notify_on_commit = notify_on_commit
         changelog_cache_size = max(1, cache_size // 20)
         relpath_cache_size = max(1, cache_size - changelog_cache_size)
-        self._changelog_cache = LRUCache(changelog_cache_size)  # is thread safe
-        self._relpath_cache = LRUCache(relpath_cache_size)  # is thread safe
+        self._changelog_cache = TwoQueueCache(changelog_cache_size)
+        self._relpath_cache = TwoQueueCache(relpath_cache_size)
         self.last_commit_timestamp = time.time()
+        # last committed serial, updated by the writers after each commit
+        self._last_serial = None
+        self._last_serial_lock = threading.Lock()
+        self._wal_enabled = False
+        self._sqlpath_exists = False
+        # idle sqlite connections of each thread for reuse
+        self._threadlocal = threading.local()
+        self._get_sqlconn = self._probe_get_sqlconn()
         self.ensure_tables_exist()
 
     def _get_sqlconn_uri_kw(self, uri):
         return sqlite3.connect(
-            uri, timeout=60, isolation_level=None, uri=True)
+            uri, timeout=self._timeout, isolation_level=None, uri=True,
+            cached_statements=256)
 
     def _get_sqlconn_uri(self, uri):
         return sqlite3.connect(
-            uri, timeout=60, isolation_level=None)
+            uri, timeout=self._timeout, isolation_level=None,
+            cached_statements=256)
 
     def _get_sqlconn_path(self, uri):
         return sqlite3.connect(
-            self.sqlpath.strpath, timeout=60, isolation_level=None)
+            self.sqlpath.strpath, timeout=self._timeout, isolation_level=None,
+            cached_statements=256)
 
-    def _get_sqlconn(self, uri):
-        # we will try different connection methods and overwrite _get_sqlconn
-        # with the first successful one
+    def _probe_get_sqlconn(self):
+        # we try the different connection methods once with an in-memory
+        # database and use the first successful one for all connections
+        uri = "file::memory:?mode=memory"
         try:
             # the uri keyword is only supported from Python 3.4 onwards and
             # possibly other Python implementations
-            conn = self._get_sqlconn_uri_kw(uri)
-            # remember for next time
-            self._get_sqlconn = self._get_sqlconn_uri_kw
-            return conn
+            self._get_sqlconn_uri_kw(uri).close()
+            return self._get_sqlconn_uri_kw
         except TypeError as e:
             if e.args and 'uri' in e.args[0] and 'keyword argument' in e.args[0]:
                 threadlog.warn(
@@ -281,10 +426,8 @@ class BaseStorage(object):
                 "keyword for 'sqlite3.connect'.")
         try:
             # sqlite3 might be compiled with default URI support
-            conn = self._get_sqlconn_uri(uri)
-            # remember for next time
-            self._get_sqlconn = self._get_sqlconn_uri
-            return conn
+            self._get_sqlconn_uri(uri).close()
+            return self._get_sqlconn_uri
         except sqlite3.OperationalError as e:
             # log the error and switch to using the path
             threadlog.warn("%s" % e)
@@ -292,40 +435,90 @@ class BaseStorage(object):
                 "Opening the sqlite3 db without options in URI. There is a "
                 "higher possibility of read/write conflicts between "
                 "threads, causing slowdowns due to retries.")
-            conn = self._get_sqlconn_path(uri)
-            # remember for next time
-            self._get_sqlconn = self._get_sqlconn_path
-            return conn
+            return self._get_sqlconn_path
+
+    def _configure_sqlconn(self, sqlconn, write):
+        if write and not self._wal_enabled:
+            # the journal mode is persisted in the database file,
+            # so it is enough to set it once on a writable connection
+            (mode,) = sqlconn.execute("PRAGMA journal_mode=WAL").fetchone()
+            if mode.lower() != "wal":
+                # sqlite returns the mode in effect, which stays the old one
+                # if the database is locked or the filesystem lacks support
+                threadlog.warn(
+                    "Could not switch the sqlite database to WAL journal "
+                    "mode, it stays in %r mode.", mode)
+            self._wal_enabled = True
+        # these only apply to the given connection
+        sqlconn.execute("PRAGMA temp_store=MEMORY")
+        sqlconn.execute("PRAGMA mmap_size=268435456")
+        sqlconn.execute("PRAGMA cache_size=-65536")
+
+    def _update_last_serial(self, serial):
+        with self._last_serial_lock:
+            if self._last_serial is None or serial > self._last_serial:
+                self._last_serial = serial
+
+    def _acquire_sqlconn(self, write):
+        # reuse the idle connection of this thread if there is one
+        attr = "rw" if write else "ro"
+        sqlconn = getattr(self._threadlocal, attr, None)
+        if sqlconn is not None:
+            setattr(self._threadlocal, attr, None)
+            return sqlconn
+        mode = attr
+        if not self._sqlpath_exists:
+            if self.sqlpath.exists():
+                self._sqlpath_exists = True
+            else:
+                mode = "rwc"
+        sqlconn = self._get_sqlconn(self._uri_template % mode)
+        self._configure_sqlconn(sqlconn, write or mode == "rwc")
+        return sqlconn
+
+    def _release_sqlconn(self, sqlconn, write):
+        if sqlconn.in_transaction:
+            sqlconn.rollback()
+        attr = "rw" if write else "ro"
+        if getattr(self._threadlocal, attr, None) is None:
+            # the idle connection lives as long as the thread, so give
+            # its page cache back instead of keeping it around
+            sqlconn.execute("PRAGMA shrink_memory")
+            setattr(self._threadlocal, attr, sqlconn)
+        else:
+            # nested connections in the same thread, keep only one
+            sqlconn.close()
 
     def get_connection(self, closing=True, write=False):
         # we let the database serialize all writers at connection time
         # to play it very safe (we don't have massive amounts of writes).
-        mode = "ro"
-        if write:
-            mode = "rw"
-        if not self.sqlpath.exists():
-            mode = "rwc"
-        uri = "file:%s?mode=%s" % (self.sqlpath, mode)
-        sqlconn = self._get_sqlconn(uri)
+        sqlconn = self._acquire_sqlconn(write)
         if write:
             start_time = time.monotonic()
             thread = current_thread()
-            while 1:
-                try:
-                    sqlconn.execute("begin immediate")
-                    break
-                except sqlite3.OperationalError:
-                    # another thread may be writing, give it a chance to finish
-                    time.sleep(0.01)
-                    if hasattr(thread, "exit_if_shutdown"):
-                        thread.exit_if_shutdown()
-                    if time.monotonic() - start_time > 30:
-                        # if it takes this long, something is wrong
-                        raise
-        conn = self.Connection(sqlconn, self.basedir, self)
-        if closing:
-            return contextlib.closing(conn)
-        return conn
+            # sqlite waits for the write lock itself, but with a short
+            # timeout, so we regularly check for shutdown
+            sqlconn.execute("PRAGMA busy_timeout=1000")
+            try:
+                while 1:
+                    try:
+                        sqlconn.execute("begin immediate")
+                        break
+                    except sqlite3.OperationalError:
+                        # another thread is still writing after sqlite
+                        # waited for the busy timeout
+                        if hasattr(thread, "exit_if_shutdown"):
+                            thread.exit_if_shutdown()
+                        if time.monotonic() - start_time > 30:
+                            # if it takes this long, something is wrong
+                            raise
+            finally:
+                # the commit might have to wait for readers without WAL,
+                # so it gets the long timeout of the connection again
+                sqlconn.execute(
+                    "PRAGMA busy_timeout=%d" % (self._timeout * 1000))
+        # the connection is its own closing context manager
+        return self.Connection(sqlconn, self.basedir, self, write=write)
 
     def _reflect_schema(self):
         result = {}
@@ -370,6 +563,9 @@ class Storage(BaseStorage):
         index=dict(
             kv_serial_idx="""
                 CREATE INDEX kv_serial_idx ON kv (serial);
+            """,
+            kv_keyname_serial_idx="""
+                CREATE INDEX kv_keyname_serial_idx ON kv (keyname, serial);
             """),
         table=dict(
             changelog="""
@@ -441,7 +637,7 @@ def devpiserver_metrics(request):
             ('devpi_server_changelog_cache_lookups', 'counter', changelog_cache.lookups),
             ('devpi_server_changelog_cache_misses', 'counter', changelog_cache.misses),
             ('devpi_server_changelog_cache_size', 'gauge', changelog_cache.size),
-            ('devpi_server_changelog_cache_items', 'gauge', len(changelog_cache.data) if changelog_cache.data else 0)])
+            ('devpi_server_changelog_cache_items', 'gauge', len(changelog_cache))])
     if relpath_cache:
         result.extend([
             ('devpi_server_relpath_cache_evictions', 'counter', relpath_cache.evictions),
@@ -449,7 +645,7 @@ def devpiserver_metrics(request):
             ('devpi_server_relpath_cache_lookups', 'counter', relpath_cache.lookups),
             ('devpi_server_relpath_cache_misses', 'counter', relpath_cache.misses),
             ('devpi_server_relpath_cache_size', 'gauge', relpath_cache.size),
-            ('devpi_server_relpath_cache_items', 'gauge', len(relpath_cache.data) if relpath_cache.data else 0)])
+            ('devpi_server_relpath_cache_items', 'gauge', len(relpath_cache))])
     return result
 
 
@@ -457,7 +653,7 @@ class LazyChangesFormatter:
     __slots__ = ('keys',)
 
     def __init__(self, changes):
-        self.keys = changes.keys()
+        self.keys = tuple(changes)
 
     def __str__(self):
         return f"keys: {','.join(repr(c) for c in self.keys)}"
@@ -473,15 +669,9 @@ class Writer:
     def record_set(self, typedkey, value=None, back_serial=None):
         """ record setting typedkey to value (None means it's deleted) """
         assert not isinstance(value, ReadonlyView), value
-        if back_serial is None:
-            try:
-                _, back_serial = self.conn.db_read_typedkey(typedkey.relpath)
-            except KeyError:
-                back_serial = -1
-        self.conn.db_write_typedkey(typedkey.relpath, typedkey.name, self.commit_serial)
-        # at __exit__ time we write out changes to the _changelog_cache
-        # so we protect here against the caller modifying the value later
-        value = get_mutable_deepcopy(value)
+        # no copy of the value is needed, at __exit__ time the changes are
+        # only serialized into the changelog, which is read back from the
+        # database with fresh objects, and nothing else runs in between
         self.changes[typedkey.relpath] = (typedkey.name, back_serial, value)
 
     def __enter__(self):
@@ -492,12 +682,15 @@ class Writer:
         commit_serial = self.commit_serial
         thread_pop_log("fswriter%s:" % commit_serial)
         if cls is None:
+            self.conn.db_write_typedkeys(self.changes, commit_serial)
             entry = self.changes, []
             self.conn.write_changelog_entry(commit_serial, entry)
             self.conn.commit()
+            self.storage._update_last_serial(commit_serial)
             self.log.info("committed at %s", commit_serial)
-            self.log.debug(
-                "committed: %s", LazyChangesFormatter(self.changes))
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug(
+                    "committed: %s", LazyChangesFormatter(self.changes))
 
             self.storage._notify_on_commit(commit_serial)
         else:
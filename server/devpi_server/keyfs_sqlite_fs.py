@@ -4,13 +4,13 @@ from .keyfs_sqlite import BaseConnection
 from .keyfs_sqlite import BaseStorage
 from .log import threadlog, thread_push_log, thread_pop_log
 from .readonly import ReadonlyView
-from .readonly import get_mutable_deepcopy
 from .fileutil import get_write_file_ensure_dir, rename, loads
 from hashlib import sha256
 from zope.interface import Interface
 from zope.interface import alsoProvides
 from zope.interface import implementer
 import errno
+import logging
 import os
 import re
 import shutil
@@ -168,6 +168,9 @@ class Storage(BaseStorage):
         index=dict(
             kv_serial_idx="""
                 CREATE INDEX kv_serial_idx ON kv (serial);
+            """,
+            kv_keyname_serial_idx="""
+                CREATE INDEX kv_keyname_serial_idx ON kv (keyname, serial);
             """),
         table=dict(
             changelog="""
@@ -209,7 +212,7 @@ class LazyChangesFormatter:
     def __init__(self, changes, files_commit, files_del):
         self.files_commit = files_commit
         self.files_del = files_del
-        self.keys = changes.keys()
+        self.keys = tuple(changes)
 
     def __str__(self):
         msg = []
@@ -232,15 +235,9 @@ class FSWriter:
     def record_set(self, typedkey, value=None, back_serial=None):
         """ record setting typedkey to value (None means it's deleted) """
         assert not isinstance(value, ReadonlyView), value
-        if back_serial is None:
-            try:
-                _, back_serial = self.conn.db_read_typedkey(typedkey.relpath)
-            except KeyError:
-                back_serial = -1
-        self.conn.db_write_typedkey(typedkey.relpath, typedkey.name, self.commit_serial)
-        # at __exit__ time we write out changes to the _changelog_cache
-        # so we protect here against the caller modifying the value later
-        value = get_mutable_deepcopy(value)
+        # no copy of the value is needed, at __exit__ time the changes are
+        # only serialized into the changelog, which is read back from the
+        # database with fresh objects, and nothing else runs in between
         self.changes[typedkey.relpath] = (typedkey.name, back_serial, value)
 
     def __enter__(self):
@@ -251,12 +248,14 @@ class FSWriter:
         commit_serial = self.commit_serial
         thread_pop_log("fswriter%s:" % commit_serial)
         if cls is None:
+            self.conn.db_write_typedkeys(self.changes, commit_serial)
             pending_renames = write_dirty_files(self.conn.dirty_files)
 
             changes_formatter = self.commit_to_filesystem(pending_renames)
 
             self.log.info("committed at %s", commit_serial)
-            self.log.debug("committed: keys: %s", changes_formatter)
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("committed: keys: %s", changes_formatter)
 
             self.storage._notify_on_commit(commit_serial)
         else:
@@ -272,6 +271,7 @@ class FSWriter:
         entry = self.changes, rel_renames
         self.conn.write_changelog_entry(self.commit_serial, entry)
         self.conn.commit()
+        self.storage._update_last_serial(self.commit_serial)
 
         # If we crash in the remainder, the next restart will
         # - call check_pending_renames which will replay any remaining
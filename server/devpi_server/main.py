@@ -5,6 +5,7 @@ recursive cache of pypi.org packages.
 """
 from __future__ import unicode_literals
 import aiohttp
+import codecs
 import inspect
 import os
 import asyncio
@@ -13,6 +14,7 @@ import sys
 import time
 import traceback
 
+from contextlib import asynccontextmanager
 from requests import Response, exceptions
 from devpi_common.types import cached_property
 from devpi_common.request import new_requests_session
@@ -198,6 +200,13 @@ class AsyncioLoopThread(object):
 
     def thread_shutdown(self):
         loop = self.loop
+        if loop.is_running():
+            closing = asyncio.run_coroutine_threadsafe(
+                self.xom._close_async_sessions(), loop)
+            try:
+                closing.result(timeout=5)
+            except Exception:
+                threadlog.exception("Exception while closing http sessions")
         try:
             loop.call_soon_threadsafe(loop.stop)
         except RuntimeError:
@@ -208,6 +217,21 @@ class AsyncioLoopThread(object):
         loop.close()
 
 
+async def iter_decoded_chunks(response, chunk_size=65536):
+    try:
+        decoder = codecs.getincrementaldecoder(response.charset or "utf-8")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")
+    decoder = decoder(errors="replace")
+    async for chunk in response.content.iter_chunked(chunk_size):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
 class XOM:
     class Exiting(SystemExit):
         pass
@@ -220,8 +244,11 @@ class XOM:
         if httpget is not None:
             self.httpget = httpget
             self.async_httpget = httpget.async_httpget
+            self.async_httpget_stream = httpget.async_httpget_stream
         self.log = threadlog
         self.polling_replicas = {}
+        # created on first use from within the async loop
+        self._async_httpsession = None
         self._stagecache = {}
         if self.is_replica():
             from devpi_server.replica import ReplicaThread
@@ -259,6 +286,11 @@ class XOM:
             raise exc
         return future.result()
 
+    def submit_coroutine(self, coroutine):
+        """ schedule the coroutine on the async loop and return a
+        concurrent.futures.Future for its result. """
+        return self._run_coroutine_threadsafe(coroutine)
+
     def create_task(self, coroutine):
         asyncio.ensure_future(coroutine, loop=self.async_thread.loop)
 
@@ -350,17 +382,50 @@ class XOM:
     def _close_sessions(self):
         self._httpsession.close()
 
+    def _get_async_httpsession(self):
+        # one session for all requests, so connections to the same host
+        # are kept alive and reused instead of doing a TLS handshake
+        # for each simple page
+        session = self._async_httpsession
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=32, keepalive_timeout=75)
+            session = self._async_httpsession = aiohttp.ClientSession(
+                connector=connector, trust_env=True)
+        return session
+
+    async def _close_async_sessions(self):
+        session = self._async_httpsession
+        self._async_httpsession = None
+        if session is not None:
+            await session.close()
+
     async def async_httpget(self, url, allow_redirects, timeout=None, extra_headers=None):
-        timeout = aiohttp.ClientTimeout(total=timeout)
-        async with aiohttp.ClientSession(timeout=timeout, trust_env=True) as session:
-            async with session.get(
-                url, allow_redirects=allow_redirects, headers=extra_headers
-            ) as response:
-                if response.status < 300:
-                    text = await response.text()
-                else:
-                    text = None
-                return (response, text)
+        session = self._get_async_httpsession()
+        async with session.get(
+            url, allow_redirects=allow_redirects, headers=extra_headers,
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            if response.status < 300:
+                text = await response.text()
+            else:
+                text = None
+            return (response, text)
+
+    @asynccontextmanager
+    async def async_httpget_stream(self, url, allow_redirects, timeout=None, extra_headers=None):
+        """ like async_httpget, but instead of the full text it provides
+        an async iterator over the decoded chunks of the body. """
+        session = self._get_async_httpsession()
+        async with session.get(
+            url, allow_redirects=allow_redirects, headers=extra_headers,
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            if response.status < 300:
+                chunks = iter_decoded_chunks(response)
+            else:
+                chunks = None
+            yield (response, chunks)
 
     def httpget(self, url, allow_redirects, timeout=None, extra_headers=None):
         if self.config.offline_mode:
@@ -32,7 +32,8 @@ notset = object()
 
 
 def join_links_data(links, requires_python, yanked):
-    # build list of (key, href, require_python, yanked) tuples
+    # build list of (key, href, require_python, yanked) tuples,
+    # keeping the order of the given links
     result = []
     links = zip_longest(links, requires_python, yanked, fillvalue=None)
     for link, require_python, yanked in links:
@@ -67,6 +67,9 @@ meta_headers = {str("X-DEVPI-API-VERSION"): str(API_VERSION),
 INSTALLER_USER_AGENT = r"([^ ]* )*(distribute|setuptools|pip|pex)/.*"
 INSTALLER_USER_AGENT_REGEXP = re.compile(INSTALLER_USER_AGENT)
 
+# block size for sending release files, the same as pyramid uses
+FILE_BLOCK_SIZE = 262144
+
 
 def abort(request, code, body):
     # if no Accept header is set, then force */*, otherwise the exception
@@ -1282,9 +1285,16 @@ class PyPIView:
         if self.request.method == "HEAD":
             return Response(headers=headers)
         else:
-            # FileIter will close the file
-            return Response(
-                app_iter=FileIter(entry.file_open_read()), headers=headers)
+            f = entry.file_open_read()
+            file_wrapper = request.environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None:
+                # the server sends the file by itself, which frees the
+                # worker thread early, like pyramid's FileResponse
+                app_iter = file_wrapper(f, FILE_BLOCK_SIZE)
+            else:
+                # FileIter will close the file
+                app_iter = FileIter(f, FILE_BLOCK_SIZE)
+            return Response(app_iter=app_iter, headers=headers)
 
     @view_config(route_name="/{user}/{index}/+e/{relpath:.*}")
     def mirror_pkgserv(self):
@@ -0,0 +1 @@
+When ``lxml`` is installed it is used to parse the simple pages of mirrored projects, which is considerably faster for projects with many release files. Without ``lxml`` the pages are parsed with ``html.parser`` from the standard library.
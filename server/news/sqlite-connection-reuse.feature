@@ -0,0 +1 @@
+The sqlite storage backends now keep one idle read-only and one idle writable database connection per thread and reuse them for the next transaction. The page cache of an idle connection is released, so the memory use doesn't grow with the number of threads.
@@ -0,0 +1 @@
+The sqlite storage backends now put the database into WAL journal mode, so reading transactions no longer block on a running write. The ``.sqlite-wal`` and ``.sqlite-shm`` files next to the database belong to it and must be included when copying the server directory of a running instance.
@@ -14,6 +14,7 @@ import sys
 import time
 from .reqmock import reqmock, patch_reqsessionmock  # noqa
 from bs4 import BeautifulSoup
+from contextlib import asynccontextmanager
 from contextlib import closing
 from devpi_server import extpypi
 from devpi_server.config import get_pluginmanager
@@ -342,6 +343,20 @@ def httpget(pypiurls):
                 text = None
             return (response, text)
 
+        @asynccontextmanager
+        async def async_httpget_stream(self, url, allow_redirects, timeout=None, extra_headers=None):
+            response = self.__call__(url, allow_redirects, extra_headers, timeout=timeout)
+            if response.status_code < 300:
+                chunks = self._iter_chunks(response.text)
+            else:
+                chunks = None
+            yield (response, chunks)
+
+        async def _iter_chunks(self, text, chunk_size=100):
+            # small chunks to exercise incremental parsing
+            for i in range(0, len(text), chunk_size):
+                yield text[i:i + chunk_size]
+
         def __call__(self, url, allow_redirects=False, extra_headers=None, **kw):
             class mockresponse:
                 def __init__(xself, url):
@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 import requests.exceptions
 import time
 import hashlib
+import threading
 import pytest
 
 from devpi_server.extpypi import URL, parse_index
@@ -17,6 +18,26 @@ def getlinks(text):
 class TestIndexParsing:
     simplepy = URL("https://pypi.org/simple/py/")
 
+    @pytest.fixture(autouse=True, params=["lxml", "htmlparser"])
+    def links_impl(self, request, monkeypatch):
+        from devpi_server import extpypi
+        if request.param == "lxml":
+            pytest.importorskip("lxml")
+        else:
+            monkeypatch.setattr(extpypi, "LXMLHTMLPullParser", None)
+        return request.param
+
+    def test_parse_index_base_href(self):
+        result = parse_index(self.simplepy, """
+            <html><head><base href="https://files.example.com/x/"></head>
+            <body><a href="py-1.0.zip">py-1.0.zip</a></body></html>""")
+        link, = result.releaselinks
+        assert link.url == "https://files.example.com/x/py-1.0.zip"
+
+    def test_parse_index_empty(self):
+        result = parse_index(self.simplepy, "")
+        assert result.releaselinks == []
+
     @pytest.mark.parametrize("hash_type,hash_value", [
         ("sha256", "090123"),
         ("sha224", "1209380123"),
@@ -247,6 +268,24 @@ class TestIndexParsing:
         assert link3.url == "https://pypi.org/pkg/py-1.4.10.zip#md5=2222"
 
 
+@pytest.mark.parametrize("project", ["py", "py-x", "ndg-httpsclient"])
+def test_indexparser_is_archive_of_project(project):
+    from devpi_common.metadata import is_archive_of_project
+    from devpi_server.extpypi import IndexParser
+    parser = IndexParser(project)
+    names = ["py", "Py", "py_x", "py.x", "pyx", "_py", "x-py", "ndg_httpsclient"]
+    versions = ["", "-1.0", "-docs-1.0", "-1.0-cp27-none-linux_x86_64", ".tar"]
+    exts = [
+        "", ".zip", ".TAR.GZ", ".tar.bz2", ".tar", ".tgz", ".doc.zip", ".whl",
+        ".egg", ".exe", ".msi", ".rpm", ".gz", ".tar.tar", ".tar.zip", ".html"]
+    for name in names:
+        for version in versions:
+            for ext in exts:
+                basename = name + version + ext
+                assert parser.is_archive_of_project(basename) == is_archive_of_project(
+                    basename, parser.project), basename
+
+
 def test_get_updated(pypistage):
     c = pypistage.cache_retrieve_times
     c2 = pypistage.cache_retrieve_times
@@ -290,6 +329,35 @@ class TestExtPYPIDB:
         assert data["version"] == "1.0"
         assert pypistage.has_project_perstage("pytest")
 
+    def test_version_index_cached(self, pypistage):
+        pypistage.mock_simple("pytest", text='''
+                <a href="../../pkg/pytest-1.0.zip" />
+                <a href="../../pkg/pytest-1.1.zip" />''')
+        assert pypistage.list_versions_perstage("pytest") == {"1.0", "1.1"}
+        index = pypistage._version_index("pytest")
+        assert pypistage._version_index("Pytest") is index
+        assert [x.version for x in index["1.1"]] == ["1.1"]
+        assert pypistage.get_versiondata_perstage("pytest", "2.0") == {}
+        pypistage.mock_simple("pytest", text='''
+                <a href="../../pkg/pytest-1.0.zip" />
+                <a href="../../pkg/pytest-1.1.zip" />
+                <a href="../../pkg/pytest-2.0.zip" />''', pypiserial=10001)
+        assert pypistage.list_versions_perstage("pytest") == {"1.0", "1.1", "2.0"}
+        assert pypistage._version_index("pytest") is not index
+        data = pypistage.get_versiondata_perstage("pytest", "2.0")
+        assert len(data["+elinks"]) == 1
+
+    def test_joined_links_cached(self, pypistage):
+        pypistage.mock_simple("pytest", text='''
+                <a href="../../pkg/pytest-1.0.zip" />''')
+        pypistage.get_releaselinks("pytest")
+        pypistage.keyfs.commit_transaction_in_thread()
+        pypistage.keyfs.begin_transaction_in_thread(write=True)
+        (_, links, _) = pypistage._load_cache_links("pytest")
+        assert pypistage._load_cache_links("pytest")[1] is links
+        pypistage.clear_simplelinks_cache("pytest")
+        assert pypistage.cache_joined_links.get("pytest") is None
+
     def test_parse_with_external_link(self, pypistage):
         md5 = getmd5("123")
         pypistage.mock_simple("pytest", text='''
@@ -368,6 +436,34 @@ class TestExtPYPIDB:
         assert ret == ret2
         assert commit_serial == pypistage.keyfs.get_current_serial()
 
+    def test_refresh_projects(self, pypistage, caplog):
+        pypistage.mock_simple("pkg1", pkgver="pkg1-1.0.zip", pypiserial=10)
+        pypistage.mock_simple("pkg2", pkgver="pkg2-2.0.zip", pypiserial=10)
+        pypistage.url2response["https://pypi.org/simple/pkg3/"] = dict(
+            status_code=404)
+        result = pypistage.refresh_projects(["pkg1", "Pkg2", "pkg3"])
+        assert sorted(result) == ["pkg1", "pkg2"]
+        ((basename, href, *_),) = result["pkg2"]
+        assert basename == "pkg2-2.0.zip"
+        recs = caplog.getrecords(".*could not refresh links for 'pkg3'.*")
+        assert len(recs) == 1
+        (link,) = pypistage.get_releaselinks("pkg1")
+        assert link.basename == "pkg1-1.0.zip"
+        assert pypistage.key_projects.get() == set(["pkg1", "pkg2"])
+
+    def test_refresh_projects_offline(self, pypistage):
+        pypistage.mock_simple("pkg1", pkgver="pkg1-1.0.zip", pypiserial=10)
+        pypistage.mock_simple("pkg2", pkgver="pkg2-2.0.zip", pypiserial=10)
+        pypistage.get_releaselinks("pkg1")
+        pypistage.mock_simple("pkg1", pkgver="pkg1-1.1.zip", pypiserial=11)
+        pypistage.offline = True
+        # nothing is fetched
+        pypistage.xom.run_coroutine_threadsafe = None
+        result = pypistage.refresh_projects(["pkg1", "pkg2"])
+        # only the cached links of cached projects are returned
+        assert result == {"pkg1": pypistage.get_simplelinks_perstage("pkg1")}
+        assert pypistage.key_projsimplelinks("pkg1").get()["serial"] == 10
+
     @pytest.mark.parametrize("errorcode", [404, -1, -2])
     def test_parse_and_scrape_error(self, pypistage, errorcode):
         pypistage.mock_simple("pytest", text='''
@@ -515,6 +611,20 @@ class TestPyPIStageprojects:
         x = pypistage._get_remote_projects()
         assert x == set(["devpi-server"])
 
+    def test_get_remote_projects_attributes(self, pypistage):
+        pypistage.xom.httpget.mockresponse(
+            pypistage.mirror_url, code=200, text="""
+            <html><body>
+                <A class="x" HREF = "/simple/foo/">foo</A>
+                <a data-href='nope' href='bar'>bar</a>
+                <a href="b&amp;z">b&amp;z</a>
+                <abbr href="abbr">abbr</abbr>
+                <a name="anchor">no href</a>
+                <a href="">empty</a>
+            </body></html>""")
+        x = pypistage._get_remote_projects()
+        assert x == set(["foo", "bar", "b&z"])
+
     @pytest.mark.notransaction
     def test_single_project_access_updates_projects(self, pypistage):
         pypistage.xom.httpget.mockresponse(
@@ -560,11 +670,14 @@ class TestPyPIStageprojects:
         import asyncio
         # release files should be updated in background in case of timeout
         pypistage.timeout = 0.1
-        orig_async_httpget = pypistage.async_httpget
+        from contextlib import asynccontextmanager
+        orig_async_httpget_stream = pypistage.async_httpget_stream
 
-        async def sleeping_async_httpget(*args, **kw):
+        @asynccontextmanager
+        async def sleeping_async_httpget_stream(*args, **kw):
             await asyncio.sleep(0.2)
-            return await orig_async_httpget(*args, **kw)
+            async with orig_async_httpget_stream(*args, **kw) as result:
+                yield result
 
         # first we need some releases in the db
         pypistage.mock_simple("pkg", text='<a href="pkg-1.0.zip"</a>')
@@ -577,7 +690,7 @@ class TestPyPIStageprojects:
         # now expire the cache, add a version on the mirror and fetch again with a timeout
         pypistage.cache_retrieve_times.expire("pkg")
         pypistage.mock_simple("pkg", text='<a href="pkg-1.0.zip"</a><a href="pkg-2.0.zip"</a>')
-        pypistage.async_httpget = sleeping_async_httpget
+        pypistage.async_httpget_stream = sleeping_async_httpget_stream
         serial = pypistage.keyfs.get_current_serial()
         # we should get stale results
         with pypistage.keyfs.transaction(write=False):
@@ -596,6 +709,41 @@ class TestPyPIStageprojects:
                 for x in pypistage.get_releaselinks("pkg")]) == sorted([
                     ('pkg', '1.0'), ('pkg', '2.0')])
 
+    @pytest.mark.notransaction
+    def test_simplelinks_timeout_update_error(self, caplog, pypistage):
+        import asyncio
+        pypistage.timeout = 0.1
+        from contextlib import asynccontextmanager
+        orig_async_httpget_stream = pypistage.async_httpget_stream
+
+        @asynccontextmanager
+        async def sleeping_async_httpget_stream(*args, **kw):
+            await asyncio.sleep(0.2)
+            async with orig_async_httpget_stream(*args, **kw) as result:
+                yield result
+
+        def failing_update_simplelinks(*args, **kw):
+            raise ValueError("update failed")
+
+        pypistage.mock_simple("pkg", text='<a href="pkg-1.0.zip"</a>')
+        with pypistage.keyfs.transaction(write=False):
+            assert len(pypistage.get_releaselinks("pkg")) == 1
+        pypistage.cache_retrieve_times.expire("pkg")
+        pypistage.mock_simple("pkg", text='<a href="pkg-1.0.zip"</a><a href="pkg-2.0.zip"</a>')
+        pypistage.async_httpget_stream = sleeping_async_httpget_stream
+        pypistage._update_simplelinks = failing_update_simplelinks
+        with pypistage.keyfs.transaction(write=False):
+            assert len(pypistage.get_releaselinks("pkg")) == 1
+        # the error of the background update is logged
+        for i in range(50):
+            recs = caplog.getrecords(
+                ".*could not update simple links for 'pkg' in background")
+            if recs:
+                break
+            time.sleep(0.1)
+        (rec,) = recs
+        assert "update failed" in str(rec.exc_info[1])
+
     @pytest.mark.nomocking
     @pytest.mark.notransaction
     def test_auth_mirror_url(self, caplog, mapp, simpypi, testapp):
@@ -757,6 +905,40 @@ class TestProjectNamesCache:
         cache.discard(5)
         assert 5 not in cache.get()
 
+    def test_get_snapshot(self, cache):
+        cache.set(set([1, 2, 3]))
+        data = cache.get()
+        assert cache.get() is data
+        cache.add(4)
+        assert 4 in cache
+        assert 4 not in data
+        assert cache.get() == set([1, 2, 3, 4])
+        cache.discard(1)
+        assert 1 not in cache
+        assert cache.get() == set([2, 3, 4])
+
+    def test_get_concurrent_add(self, cache, monkeypatch):
+        from devpi_server import extpypi
+        threads = []
+
+        class Snapshot(frozenset):
+            def __new__(cls, data):
+                if not threads:
+                    # another thread adds a project while get builds
+                    # the snapshot
+                    t = threading.Thread(target=cache.add, args=(4,))
+                    threads.append(t)
+                    t.start()
+                    t.join(0.1)
+                return super().__new__(cls, data)
+
+        monkeypatch.setattr(extpypi, "frozenset", Snapshot, raising=False)
+        cache.set([1, 2, 3])
+        assert cache.get() == set([1, 2, 3])
+        threads[0].join()
+        # the snapshot from before the add isn't used anymore
+        assert cache.get() == set([1, 2, 3, 4])
+
     def test_is_expired(self, cache, monkeypatch):
         expiry_time = 100
         s = set([1,2,3])
@@ -774,8 +956,8 @@ def test_ProjectUpdateCache(monkeypatch):
     assert x.is_expired("x", expiry_time)
     x.refresh("x")
     assert not x.is_expired("x", expiry_time)
-    t = time.time() + 35
-    monkeypatch.setattr("time.time", lambda: t)
+    t = time.monotonic_ns() + 35 * 1_000_000_000
+    monkeypatch.setattr("time.monotonic_ns", lambda: t)
     assert x.is_expired("x", expiry_time)
     x.refresh("x")
     assert not x.is_expired("x", expiry_time)
@@ -1,3 +1,4 @@
+from devpi_server.filestore import key_from_link
 from devpi_server.views import iter_cache_remote_file
 from webob.headers import ResponseHeaders
 import hashlib
@@ -44,6 +45,19 @@ class TestFileStore:
         assert parent2 == link.hash_value[3:16]
         assert getattr(hashlib, hash_spec.split("=")[0]) == link.hash_algo
 
+    def test_maplink_many(self, filestore, gen):
+        links = [
+            gen.pypi_package_link("pytest-1.2.zip"),
+            gen.pypi_package_link("pytest-1.3.zip", md5=False)]
+        filestore.maplink_many(links, "root", "pypi", "pytest")
+        for link, version in zip(links, ("1.2", "1.3")):
+            relpath = key_from_link(filestore.keyfs, link, "root", "pypi").relpath
+            entry = filestore.get_file_entry(relpath)
+            assert entry.url == link.geturl_nofragment().url
+            assert entry.hash_spec == link.hash_spec
+            assert entry.project == "pytest"
+            assert entry.version == version
+
     def test_maplink(self, filestore, gen):
         link = gen.pypi_package_link("pytest-1.2.zip")
         entry1 = filestore.maplink(link, "root", "pypi", "pytest")
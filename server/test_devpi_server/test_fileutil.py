@@ -3,6 +3,7 @@ from devpi_server.fileutil import DumpError
 from devpi_server.fileutil import LoadError
 from devpi_server.fileutil import dumplen
 from devpi_server.fileutil import dumps
+from devpi_server.fileutil import load
 from devpi_server.fileutil import loads
 from execnet.gateway_base import _Serializer
 from execnet.gateway_base import DumpError as _DumpError
@@ -73,6 +74,9 @@ def test_loads(data, expected):
     result = loads(data)
     assert result == expected
     assert type(result) == type(expected)
+    result = load(BytesIO(data))
+    assert result == expected
+    assert type(result) is type(expected)
     result = _loads(data)
     assert result == expected
     assert type(result) == type(expected)
@@ -118,3 +122,5 @@ def test_loads_bad_data():
     with pytest.raises(LoadError) as e:
         loads(b'LCQ')
     assert msg == str(e.value)
+    with pytest.raises(EOFError):
+        loads(b'N\x00\x00\x00\x01')
@@ -1,6 +1,8 @@
 import contextlib
 import py
 import pytest
+import sqlite3
+import threading
 from devpi_server.mythread import ThreadPool
 
 from devpi_server.keyfs import KeyFS, Transaction
@@ -833,7 +835,9 @@ def test_keyfs_sqlite(gentmp):
     with keyfs.transaction(write=False) as tx:
         assert tx.conn.io_file_os_path('foo') is None
         assert tx.conn.io_file_get('foo') == b'bar'
-    assert [x.basename for x in tmp.listdir()] == ['.sqlite_db']
+    assert [
+        x.basename for x in tmp.listdir()
+        if not x.basename.endswith(("-wal", "-shm"))] == ['.sqlite_db']
 
 
 def test_keyfs_sqlite_fs(gentmp):
@@ -848,7 +852,159 @@ def test_keyfs_sqlite_fs(gentmp):
         assert tx.conn.io_file_get('foo') == b'bar'
         with open(tx.conn.io_file_os_path('foo'), 'rb') as f:
             assert f.read() == b'bar'
-    assert sorted(x.basename for x in tmp.listdir()) == ['.sqlite', 'foo']
+    assert sorted(
+        x.basename for x in tmp.listdir()
+        if not x.basename.endswith(("-wal", "-shm"))) == ['.sqlite', 'foo']
+
+
+def test_sqlite_wal_mode(gentmp, caplog):
+    from devpi_server import keyfs_sqlite_fs
+    keyfs = KeyFS(gentmp(), keyfs_sqlite_fs.Storage)
+    storage = keyfs._storage
+    with keyfs.get_connection() as conn:
+        (mode,) = conn.fetchone("PRAGMA journal_mode")
+    assert mode == "wal"
+    assert not caplog.getrecords("WAL")
+
+    class SQLConn:
+        def execute(self, q):
+            return sqlite3.connect(":memory:").execute(
+                "SELECT 'delete'" if "journal_mode" in q else q)
+
+    storage._wal_enabled = False
+    storage._configure_sqlconn(SQLConn(), True)
+    assert storage._wal_enabled
+    (rec,) = caplog.getrecords("WAL")
+    assert "'delete'" in rec.getMessage()
+
+
+def test_sqlite_keyname_serial_index(gentmp):
+    from devpi_server import keyfs_sqlite_fs
+    tmp = gentmp()
+    keyfs = KeyFS(tmp, keyfs_sqlite_fs.Storage)
+    schema = keyfs._storage._reflect_schema()
+    assert "kv_keyname_serial_idx" in schema["index"]
+    # the query of iter_relpaths_at uses the index without sorting
+    with keyfs.get_connection() as conn:
+        plan = conn._explain_query_plan("""
+            SELECT key, keyname, serial
+            FROM kv
+            WHERE keyname=? AND serial<=?
+            ORDER BY serial DESC""", ("NAME", 0))
+    (detail,) = [row[-1] for row in plan]
+    assert "USING INDEX kv_keyname_serial_idx" in detail
+
+
+def test_sqlite_connection_reused(gentmp):
+    from devpi_server import keyfs_sqlite_fs
+    tmp = gentmp()
+    keyfs = KeyFS(tmp, keyfs_sqlite_fs.Storage)
+    with keyfs.get_connection() as conn:
+        assert isinstance(conn, keyfs_sqlite_fs.Connection)
+        sqlconn = conn._sqlconn
+    # leaving the context closes the connection
+    assert conn._sqlconn is None
+    with keyfs.get_connection() as conn:
+        assert conn._sqlconn is sqlconn
+        # nested connections get their own sqlite connection
+        with keyfs.get_connection() as conn2:
+            assert conn2._sqlconn is not sqlconn
+    with keyfs.get_connection(write=True) as conn:
+        assert conn._sqlconn is not sqlconn
+    # a connection from another thread isn't shared
+    result = []
+
+    def read():
+        with keyfs.get_connection() as conn:
+            result.append(conn._sqlconn)
+
+    t = threading.Thread(target=read)
+    t.start()
+    t.join()
+    assert result[0] is not sqlconn
+
+
+def test_sqlite_write_connection_waits(gentmp):
+    from devpi_server import keyfs_sqlite_fs
+    keyfs = KeyFS(gentmp(), keyfs_sqlite_fs.Storage)
+    conn = keyfs.get_connection(write=True, closing=False)
+    result = []
+
+    def write():
+        with keyfs.get_connection(write=True) as conn:
+            result.append(conn.last_changelog_serial)
+            # the short timeout is only used while waiting for the lock
+            result.append(conn.fetchone("PRAGMA busy_timeout")[0])
+
+    t = threading.Thread(target=write)
+    t.start()
+    # longer than the busy timeout of the connection
+    t.join(1.5)
+    assert t.is_alive()
+    conn.close()
+    t.join()
+    assert result == [-1, 60000]
+
+
+def test_sqlite_relpath_caches(gentmp):
+    from devpi_server import keyfs_sqlite_fs
+    keyfs = KeyFS(gentmp(), keyfs_sqlite_fs.Storage)
+    storage = keyfs._storage
+    small = keyfs.add_key("SMALL", "small", int)
+    big = keyfs.add_key("BIG", "big", dict)
+    with keyfs.transaction(write=True):
+        small.set(1)
+        big.set({str(i): "x" * 100 for i in range(1000)})
+    storage._changelog_cache.clear()
+    with keyfs.get_connection() as conn:
+        result = conn.get_relpath_at(small.relpath, 0)
+        assert result == (0, -1, 1)
+        assert storage._relpath_cache.get((0, small.relpath)) is result
+        result = conn.get_relpath_at(big.relpath, 0)
+        assert storage._changelog_cache.get((0, big.relpath)) is result
+        assert storage._relpath_cache.get((0, big.relpath)) is None
+        # hits are returned from the caches
+        assert conn.get_relpath_at(big.relpath, 0) is result
+
+
+def test_last_changelog_serial_memoized(gentmp):
+    from devpi_server import keyfs_sqlite_fs
+    keyfs = KeyFS(gentmp(), keyfs_sqlite_fs.Storage)
+    keyfs.finalize_init()
+    storage = keyfs._storage
+    key = keyfs.add_key("NAME", "hello", int)
+    with keyfs.transaction(write=True):
+        key.set(1)
+    assert storage._last_serial == 0
+    with keyfs.get_connection() as conn:
+        conn.db_read_last_changelog_serial = None
+        assert conn.last_changelog_serial == 0
+    with keyfs.transaction(write=True):
+        key.set(2)
+    assert storage._last_serial == 1
+    with keyfs.get_connection() as conn:
+        conn.db_read_last_changelog_serial = None
+        assert conn.last_changelog_serial == 1
+    # a failed commit doesn't change it
+    with pytest.raises(ValueError):
+        with keyfs.transaction(write=True):
+            key.set(3)
+            raise ValueError
+    assert storage._last_serial == 1
+
+
+@notransaction
+def test_iter_relpaths_at_many_keynames(keyfs):
+    key1 = keyfs.add_key("NAME1", "k1", int)
+    key2 = keyfs.add_key("NAME2", "k2", int)
+    for key in (key1, key2, key1):
+        with keyfs.transaction(write=True):
+            key.set(keyfs.get_current_serial())
+    with keyfs.transaction(write=False) as tx:
+        result = [
+            (x.keyname, x.serial)
+            for x in tx.iter_relpaths_at([key1, key2], tx.at_serial)]
+    assert result == [("NAME1", 2), ("NAME2", 1)]
 
 
 @notransaction
@@ -863,3 +1019,101 @@ def test_iter_relpaths_at(keyfs):
         (relpath_info,) = list(tx.iter_relpaths_at([key], tx.at_serial))
     assert relpath_info.keyname == "NAME1"
     assert relpath_info.value == 1
+
+
+@notransaction
+def test_back_serial_many_keys(keyfs):
+    pkey = keyfs.add_key("NAME1", "{name}", int)
+    keys = [pkey(name="k%i" % i) for i in range(1200)]
+    with keyfs.transaction(write=True):
+        for key in keys[:700]:
+            key.set(1)
+    first_serial = keyfs.get_current_serial()
+    with keyfs.transaction(write=True):
+        for key in keys:
+            key.set(2)
+    with keyfs.transaction(write=False) as tx:
+        changes = tx.conn.get_changes(tx.at_serial)
+    for i, key in enumerate(keys):
+        (keyname, back_serial, val) = changes[key.relpath]
+        assert val == 2
+        assert back_serial == (first_serial if i < 700 else -1)
+
+
+@notransaction
+def test_back_serial_set_and_delete(keyfs):
+    key1 = keyfs.add_key("NAME1", "k1", int)
+    key2 = keyfs.add_key("NAME2", "k2", int)
+    with keyfs.transaction(write=True):
+        key1.set(1)
+        key2.set(1)
+    first_serial = keyfs.get_current_serial()
+    with keyfs.transaction(write=True):
+        # deleting doesn't look up the original value
+        key1.delete()
+        key2.set(2)
+    second_serial = keyfs.get_current_serial()
+    with keyfs.transaction(write=True):
+        # the original is known to be deleted
+        key1.set(3)
+        key2.delete()
+    with keyfs.transaction(write=False) as tx:
+        changes = tx.conn.get_changes(second_serial)
+        assert changes[key1.relpath] == ("NAME1", first_serial, None)
+        assert changes[key2.relpath] == ("NAME2", first_serial, 2)
+        changes = tx.conn.get_changes(tx.at_serial)
+        assert changes[key1.relpath] == ("NAME1", second_serial, 3)
+        assert changes[key2.relpath] == ("NAME2", second_serial, None)
+
+
+@notransaction
+def test_back_serial_commit_in_between(keyfs):
+    key = keyfs.add_key("NAME1", "k1", int)
+    with keyfs.transaction(write=True):
+        key.set(1)
+    first_serial = keyfs.get_current_serial()
+    tx = Transaction(keyfs, write=True)
+    assert tx.get(key) == 1
+    # release the write lock, so another connection can commit, like with
+    # storages which only lock in the writer
+    tx.conn._sqlconn.rollback()
+    with keyfs.transaction(write=True):
+        key.set(2)
+    second_serial = keyfs.get_current_serial()
+    write_transaction = tx.conn.write_transaction
+
+    def locking_write_transaction():
+        tx.conn._sqlconn.execute("begin immediate")
+        del tx.conn.last_changelog_serial
+        return write_transaction()
+
+    tx.conn.write_transaction = locking_write_transaction
+    tx.set(key, 3)
+    assert tx.commit() == second_serial + 1
+    with keyfs.transaction(write=False) as tx:
+        changes = tx.conn.get_changes(tx.at_serial)
+    assert first_serial != second_serial
+    assert changes[key.relpath] == ("NAME1", second_serial, 3)
+
+
+def test_two_queue_cache():
+    from devpi_server.keyfs_sqlite import TwoQueueCache
+    cache = TwoQueueCache(8)
+    cache.put("hot", 1)
+    # pushed out of the FIFO queue by other entries
+    for i in range(8):
+        cache.put(i, i)
+    assert cache.get("hot") is None
+    # requested again it ends up in the main queue
+    cache.put("hot", 1)
+    # a scan doesn't evict it anymore
+    for i in range(100, 200):
+        cache.put(i, i)
+    assert cache.get("hot") == 1
+    assert len(cache) <= 8
+    assert cache.lookups == 2
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert cache.evictions > 0
+    cache.invalidate("hot")
+    assert cache.get("hot") is None
@@ -38,6 +38,14 @@ def test_taglogger_prefix(caplog):
     assert caplog.getrecords("hello this")
 
 
+def test_taglogger_debug_disabled(taglogger, caplog):
+    caplog.set_level(logging.INFO)
+    assert not taglogger.isEnabledFor(logging.DEBUG)
+    assert taglogger.isEnabledFor(logging.INFO)
+    taglogger.debug("hello")
+    assert caplog.records == []
+
+
 def test_taglogger_exception(taglogger, caplog):
     try:
         0/0
@@ -391,3 +391,27 @@ def test_root_passwd_hash_option(gentmp, makexom, storage_info):
         user = xom.model.get_user('root')
         assert not user.validate("")
         assert user.validate("foobar")
+
+
+@pytest.mark.parametrize("charset", [None, "utf-8", "latin-1", "unknown"])
+def test_iter_decoded_chunks(charset):
+    import asyncio
+    from devpi_server.main import iter_decoded_chunks
+    text = "<a href='päkg-1.0.zip'>päkg</a>"
+    data = text.encode("latin-1" if charset == "latin-1" else "utf-8")
+
+    class Content:
+        async def iter_chunked(self, size):
+            # split multibyte characters between chunks
+            for i in range(len(data)):
+                yield data[i:i + 1]
+
+    class Response:
+        content = Content()
+
+    Response.charset = charset
+
+    async def collect():
+        return [x async for x in iter_decoded_chunks(Response())]
+
+    assert "".join(asyncio.run(collect())) == text
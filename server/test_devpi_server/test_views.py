@@ -7,6 +7,7 @@ import py
 import json
 import posixpath
 from bs4 import BeautifulSoup
+from contextlib import asynccontextmanager
 
 from pyramid.response import Response
 from devpi_common.metadata import splitbasename
@@ -654,6 +655,24 @@ def test_pkgserv(httpget, pypistage, testapp):
     assert r.body == b"123"
 
 
+def test_pkgserv_file_wrapper(mapp, testapp):
+    from pyramid.response import FileIter
+    wrapped = []
+
+    def file_wrapper(f, block_size):
+        wrapped.append(block_size)
+        return FileIter(f, block_size)
+
+    api = mapp.create_and_use()
+    mapp.upload_file_pypi("pkg1-2.6.tgz", b"123", "pkg1", "2.6")
+    r = testapp.get(api.simpleindex + "pkg1/")
+    href = getfirstlink(r.text).get("href")
+    url = URL(r.request.url).joinpath(href).url
+    r = testapp.get(url, extra_environ={"wsgi.file_wrapper": file_wrapper})
+    assert r.body == b"123"
+    assert wrapped == [262144]
+
+
 def test_pkgserv_caching(mapp, testapp):
     api = mapp.create_and_use()
     mapp.upload_file_pypi("pkg1-2.6.tgz", b"123", "pkg1", "2.6")
@@ -1594,13 +1613,14 @@ def test_delete_mirror(mapp, simpypi, testapp, xom):
         key = testapp.xom.filestore.get_key_from_relpath(path.strip("/"))
         assert not key.exists()
 
-    # patch async_httpget to simulate broken PyPI
-    async def async_httpget(url, **kwargs):
+    # patch async_httpget_stream to simulate broken PyPI
+    @asynccontextmanager
+    async def async_httpget_stream(url, **kwargs):
         class Response:
             status = 503
             reason = "Service Unavailable"
-        return (Response(), None)
-    xom.async_httpget = async_httpget
+        yield (Response(), None)
+    xom.async_httpget_stream = async_httpget_stream
 
     # to prove that all metadata is gone when deleting the stage,
     # we recreate the stage, block access to PyPI